@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+"""Micro-benchmark of decoding a full-screen framebuffer update.
+
+Feeds a server -> client FramebufferUpdate message to VNCDoToolClient the
+way the network delivers it, in TCP sized chunks, and reports how long
+decoding into the framebuffer takes.
+
+Usage: rfb_decode.py [RECORDING [CHUNK_SIZE]]
+
+RECORDING is a file with one raw FramebufferUpdate message as received
+from the server after the pixel format was set to the client's default.
+Without it 1024x768 updates are generated: RAW sent as a single rectangle
+and split into 16x16 tiles, Hextile of raw tiles only, and Hextile, RRE
+and CoRRE encoded screens of windows and text-like noise. Decoded generated updates are also compared
+with the pixels they were generated from.
+"""
+
+import os
+import struct
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "xpresserng"))
+
+import numpy
+
+from vncdotool.client import VNCDoToolClient, VNCDoToolFactory
+from vncdotool import rfb
+
+WIDTH = 1024
+HEIGHT = 768
+ROUNDS = 10
+
+
+class NullTransport(object):
+    def write(self, data):
+        pass
+
+
+def generated_update(tile, width=WIDTH, height=HEIGHT):
+    pixels = numpy.random.RandomState(0).randint(0, 256, (height, width, 4)).astype(numpy.uint8)
+    rectangles = []
+    for y in xrange(0, height, tile):
+        for x in xrange(0, width, tile):
+            w, h = min(tile, width - x), min(tile, height - y)
+            rectangles.append(struct.pack("!HHHHi", x, y, w, h, rfb.RAW_ENCODING) +
+                              pixels[y:y + h, x:x + w].tostring())
+    return struct.pack("!BxH", 0, len(rectangles)) + "".join(rectangles), pixels
+
+
+def random_color(random):
+    return random.randint(0, 256, 4).astype(numpy.uint8)
+
+
+def rre_update(coordinates, tile, width=WIDTH, height=HEIGHT):
+    """RRE ("H" coordinates) or CoRRE ("B") rectangles of tile size, each
+       a background with a few hundred small subrects"""
+    random = numpy.random.RandomState(1)
+    pixels = numpy.zeros((height, width, 4), numpy.uint8)
+    encoding = rfb.RRE_ENCODING if coordinates == "H" else rfb.CORRE_ENCODING
+    rectangles = []
+    for y in xrange(0, height, tile):
+        for x in xrange(0, width, tile):
+            w, h = min(tile, width - x), min(tile, height - y)
+            background = random_color(random)
+            pixels[y:y + h, x:x + w] = background
+            subrects = []
+            for _ in xrange(300):
+                sx, sy = random.randint(0, w), random.randint(0, h)
+                sw, sh = random.randint(1, w - sx + 1), random.randint(1, min(h - sy, 12) + 1)
+                color = random_color(random)
+                pixels[y + sy:y + sy + sh, x + sx:x + sx + sw] = color
+                subrects.append(color.tostring() + struct.pack("!" + coordinates * 4, sx, sy, sw, sh))
+            rectangles.append(struct.pack("!HHHHiI", x, y, w, h, encoding, len(subrects)) +
+                              background.tostring() + "".join(subrects))
+    return struct.pack("!BxH", 0, len(rectangles)) + "".join(rectangles), pixels
+
+
+def hextile_update(kinds=4, width=WIDTH, height=HEIGHT):
+    """one Hextile rectangle with raw, solid, single and multi colour tiles,
+       only raw ones with kinds 1"""
+    random = numpy.random.RandomState(2)
+    pixels = numpy.zeros((height, width, 4), numpy.uint8)
+    tiles = []
+    for y in xrange(0, height, 16):
+        for x in xrange(0, width, 16):
+            w, h = min(16, width - x), min(16, height - y)
+            kind = random.randint(0, kinds)
+            if kind == 0:
+                pixels[y:y + h, x:x + w] = random.randint(0, 256, (h, w, 4))
+                tiles.append(chr(1) + pixels[y:y + h, x:x + w].tostring())
+                continue
+            background = random_color(random)
+            pixels[y:y + h, x:x + w] = background
+            if kind == 1:
+                tiles.append(chr(2) + background.tostring())
+                continue
+            foreground = random_color(random)
+            subrects = []
+            for _ in xrange(random.randint(1, 20)):
+                sx, sy = random.randint(0, w), random.randint(0, h)
+                sw, sh = random.randint(1, w - sx + 1), random.randint(1, h - sy + 1)
+                color = foreground if kind == 2 else random_color(random)
+                pixels[y + sy:y + sy + sh, x + sx:x + sx + sw] = color
+                subrect = chr(sx << 4 | sy) + chr((sw - 1) << 4 | (sh - 1))
+                subrects.append(subrect if kind == 2 else color.tostring() + subrect)
+            if kind == 2:
+                header = chr(2 | 4 | 8) + background.tostring() + foreground.tostring()
+            else:
+                header = chr(2 | 8 | 16) + background.tostring()
+            tiles.append(header + chr(len(subrects)) + "".join(subrects))
+    rectangle = struct.pack("!HHHHi", 0, 0, width, height, rfb.HEXTILE_ENCODING) + "".join(tiles)
+    return struct.pack("!BxH", 0, 1) + rectangle, pixels
+
+
+def connected_client(width=WIDTH, height=HEIGHT):
+    """Return client in the state right after the server initialisation."""
+    client = VNCDoToolClient()
+    client.factory = VNCDoToolFactory()
+    client.transport = NullTransport()
+    client.width, client.height = width, height
+    client.setPixelFormat()
+    client.framebuffer = numpy.zeros((height, width, client.bypp), numpy.uint8)
+    client._handler = client._handleExpected
+    client.expect(client._handleConnection, 1)
+    return client
+
+
+def decode(message, chunk_size, expected=None):
+    client = connected_client()
+    start = time.time()
+    for offset in xrange(0, len(message), chunk_size):
+        client.dataReceived(message[offset:offset + chunk_size])
+    elapsed = time.time() - start
+    if expected is not None and not numpy.array_equal(client.framebuffer, expected):
+        raise AssertionError("decoded framebuffer differs from the generated one")
+    return elapsed
+
+
+def main():
+    if len(sys.argv) > 1:
+        with open(sys.argv[1], "rb") as f:
+            messages = [(sys.argv[1], (f.read(), None))]
+    else:
+        messages = [("single rectangle", generated_update(max(WIDTH, HEIGHT))),
+                    ("16x16 tiles", generated_update(16)),
+                    ("hextile", hextile_update()),
+                    ("hextile raw tiles", hextile_update(1)),
+                    ("rre", rre_update("H", 256)),
+                    ("corre", rre_update("B", 128))]
+    chunk_sizes = [int(sys.argv[2])] if len(sys.argv) > 2 else [1460, 65536, 1 << 20]
+
+    for name, (message, expected) in messages:
+        print "%s, update of %d bytes" % (name, len(message))
+        for chunk_size in chunk_sizes:
+            best = min(decode(message, chunk_size, expected) for _ in xrange(ROUNDS))
+            print "  chunks of %7d bytes: %8.2f ms per update" % (chunk_size, best * 1000)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+"""Micro-benchmark of finding images on the screen.
+
+Reports how long one poll, i.e. one OpenCVFinder.find call on a new
+screenshot, takes for templates of several sizes and for one which is not
+on the screen, with full resolution matching, in pyramid mode and, when
+the futures package is available, with a pool of THREADS threads. All have
+to find templates at the same position, which is also checked for CROPS
+random crops of the screen. Then find_any of all templates is timed. With
+threads, find and find_any have to return exactly what they return
+without them.
+
+Usage: template_match.py [SCREENSHOT [THREADS]]
+
+SCREENSHOT is an image file of the screen; templates are cut out of it.
+Without it a 1024x768 screen of windows and text-like noise is generated.
+"""
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import cv2
+import numpy
+
+try:
+    from concurrent.futures import ThreadPoolExecutor
+except ImportError:
+    ThreadPoolExecutor = None
+
+from xpresserng.image import Image, Screenshot
+from xpresserng.opencvfinder import OpenCVFinder
+
+WIDTH = 1024
+HEIGHT = 768
+ROUNDS = 10
+CROPS = 100
+# pyramid mode matches in windows, which changes the last float digits
+SIMILARITY_TOLERANCE = 1e-4
+# (x, y, width, height) of templates cut out of the screen
+TEMPLATES = [(400, 300, 16, 16), (100, 650, 48, 24), (700, 500, 96, 32), (300, 200, 160, 96)]
+# which of TEMPLATES is also polled mirrored, i.e. not on the screen
+ABSENT = 1
+
+
+def generated_screen(width=WIDTH, height=HEIGHT):
+    random = numpy.random.RandomState(0)
+    screen = numpy.empty((height, width, 3), numpy.uint8)
+    screen[:] = (200, 180, 160)
+    for _ in xrange(30):
+        x, y = random.randint(0, width - 100), random.randint(0, height - 60)
+        w, h = random.randint(60, width - x + 1), random.randint(40, height - y + 1)
+        screen[y:y + h, x:x + w] = random.randint(0, 256, 3)
+        screen[y:y + 20, x:x + w] = random.randint(0, 256, 3)
+    # lines of "text"
+    for _ in xrange(200):
+        x, y = random.randint(0, width - 200), random.randint(0, height - 8)
+        glyphs = random.randint(0, 2, (8, random.randint(20, 200))).astype(bool)
+        screen[y:y + 8, x:x + glyphs.shape[1]][glyphs] = random.randint(0, 100, 3)
+    return screen
+
+
+def poll(finder, screen, image):
+    # every poll gets a new screenshot, nothing of the screen is cached
+    start = time.time()
+    match = finder.find(Screenshot(screen), image)
+    return time.time() - start, match
+
+
+def random_crops(screen, count=CROPS):
+    random = numpy.random.RandomState(1)
+    height, width = screen.shape[:2]
+    for _ in xrange(count):
+        w, h = random.randint(8, 200), random.randint(8, 120)
+        x, y = random.randint(0, width - w + 1), random.randint(0, height - h + 1)
+        yield x, y, w, h
+
+
+def check_agreement(name, finder, reference, screen, tolerance=0):
+    """Assert finder finds random crops where reference finder does."""
+    for x, y, width, height in random_crops(screen):
+        image = Image(array=screen[y:y + height, x:x + width].copy())
+        match = finder.find(Screenshot(screen), image)
+        expected = reference.find(Screenshot(screen), image)
+        assert (match is None) == (expected is None), (name, x, y, width, height)
+        if match is not None:
+            assert (match.x, match.y) == (expected.x, expected.y), (name, x, y, width, height)
+            assert abs(match.similarity - expected.similarity) <= tolerance, \
+                (name, x, y, width, height, match.similarity, expected.similarity)
+
+
+def check_find_any(name, finder, reference, screen, group=4):
+    """Assert finder.find_any returns exactly what reference does."""
+    crops = list(random_crops(screen))
+    for start in xrange(0, len(crops), group):
+        images = [Image(array=screen[y:y + height, x:x + width].copy())
+                  for x, y, width, height in crops[start:start + group]]
+        for best in (False, True):
+            match = finder.find_any(Screenshot(screen), images, best=best)
+            expected = reference.find_any(Screenshot(screen), images, best=best)
+            assert (match is None) == (expected is None), (name, start, best)
+            if match is not None:
+                assert (match.image is expected.image, match.x, match.y, match.similarity) == \
+                    (True, expected.x, expected.y, expected.similarity), (name, start, best)
+
+
+def timed_find_any(finder, screen, images):
+    start = time.time()
+    finder.find_any(Screenshot(screen), images, best=True)
+    return time.time() - start
+
+
+def main():
+    if len(sys.argv) > 1:
+        screen = cv2.imread(sys.argv[1])
+    else:
+        screen = generated_screen()
+    finders = [("full", OpenCVFinder()), ("pyramid", OpenCVFinder(pyramid=True))]
+    if ThreadPoolExecutor is not None:
+        threads = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+        executor = ThreadPoolExecutor(threads)
+        finders.append(("threads", OpenCVFinder(executor=executor)))
+
+    polls = [("template %dx%d at %d,%d" % (width, height, x, y),
+              screen[y:y + height, x:x + width].copy())
+             for x, y, width, height in TEMPLATES]
+    # what polls cost while waiting for an image which is not there yet
+    x, y, width, height = TEMPLATES[ABSENT]
+    polls.append(("absent template %dx%d, %d,%d mirrored" % (width, height, x, y),
+                  cv2.flip(screen[y:y + height, x:x + width], 1)))
+    for title, array in polls:
+        image = Image(array=array, width=len(array[0]), height=len(array))
+        print title
+        for name, finder in finders:
+            best, match = min(poll(finder, screen, image) for _ in xrange(ROUNDS))
+            found = "not found" if match is None else "found at %d,%d" % (match.x, match.y)
+            print "  %-8s %8.2f ms per poll, %s" % (name, best * 1000, found)
+
+    reference = finders[0][1]
+    check_agreement("pyramid", OpenCVFinder(pyramid=True), reference, screen,
+                    SIMILARITY_TOLERANCE)
+    print "pyramid agrees with full resolution matching on %d crops" % CROPS
+
+    if ThreadPoolExecutor is not None:
+        # fresh finders, remembered positions would let them differ
+        check_agreement("threads", OpenCVFinder(executor=executor), OpenCVFinder(), screen)
+        for name, pyramid in [("threads", False), ("pyramid threads", True)]:
+            check_find_any(name, OpenCVFinder(pyramid=pyramid, executor=executor),
+                           OpenCVFinder(pyramid=pyramid), screen)
+        finders.append(("pyramid threads", OpenCVFinder(pyramid=True, executor=executor)))
+        print "find and find_any with %d threads agree with sequential matching" % threads
+
+    images = [Image(array=screen[y:y + height, x:x + width].copy())
+              for x, y, width, height in TEMPLATES]
+    print "find_any of all templates, the most similar one"
+    for name, finder in finders:
+        best = min(timed_find_any(finder, screen, images) for _ in xrange(ROUNDS))
+        print "  %-16s %8.2f ms per poll" % (name, best * 1000)
+
+
+if __name__ == "__main__":
+    main()
@@ -169,6 +169,10 @@ def run(path, config):
                 passed.append(test)
 
         print datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S") + " " + test.name + " finished."
+        actions, saved = test.xpng.pacing_stats()
+        print "Adaptive pacing saved {0:.1f} s in {1} actions.".format(saved, actions)
+        hits, lookups = test.xpng.prior_stats()
+        print "Images found at known positions {0} of {1} times.".format(hits, lookups)
 
         sys.stdout.prefix = "[INFO]"
         sys.stdout.in_test = False
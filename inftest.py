@@ -61,7 +61,7 @@ class InfinityTest(object):
             else:
                 created = True
 
-        self.xpng = Xpresserng(self.vm.ip, self.vm.port)
+        self.xpng = Xpresserng(self.vm.ip, self.vm.port, adaptive=True)
 
         if self.verbose:
             print "Connect to VNC using: vncviewer -shared -viewonly", self.vm.vnc_info()
@@ -72,6 +72,7 @@ class InfinityTest(object):
             self.xpng.set_recording(os.path.join(inflogging.CURRENT_LOGDIR, inflogging.nameify(self.name) + ".avi"))
 
     def tear_down(self):
+        self.xpng.close()
         base.tear_down(self.vm)
         #TODO: ...
 
@@ -1,4 +1,10 @@
-import time
+from infexceptions import InfinityTestException
+
+
+def wait_until_stable(xpng):
+    if not xpng.wait_until_stable():
+        raise InfinityTestException("Screen did not stop changing.")
+
 
 def main(xpng):
     xpng.wait("grub")
@@ -22,34 +28,38 @@ def main(xpng):
     print "Installation had started."
     xpng.click("installation")
     xpng.wait("root_pass", 5)
-    xpng.type("fedora")
-    xpng.type("<tab>")
-    xpng.type("fedora")
+    with xpng.batch():
+        xpng.type("fedora")
+        xpng.type("<tab>")
+        xpng.type("fedora")
     xpng.wait("root_typed", 5)
     xpng.type(["<alt>", "d"])
-    time.sleep(1)
+    wait_until_stable(xpng)
     xpng.type(["<alt>", "d"])
     xpng.wait("user_installation", 5)
     print "Root account created."
     xpng.click("user_installation")
     xpng.wait("user_create", 10)
-    xpng.type("test")
-    xpng.type("<space>")
-    xpng.type("user")
-    xpng.type("<tab>")
-    xpng.type("user")
-    xpng.type("<tab>")
-    time.sleep(1)
-    xpng.type("<space>")
-    xpng.type("<tab>")
-    time.sleep(1)
-    xpng.type("<tab>")
-    xpng.type("fedora")
-    xpng.type("<tab>")
-    xpng.type("fedora")
+    with xpng.batch():
+        xpng.type("test")
+        xpng.type("<space>")
+        xpng.type("user")
+        xpng.type("<tab>")
+        xpng.type("user")
+        xpng.type("<tab>")
+    wait_until_stable(xpng)
+    with xpng.batch():
+        xpng.type("<space>")
+        xpng.type("<tab>")
+    wait_until_stable(xpng)
+    with xpng.batch():
+        xpng.type("<tab>")
+        xpng.type("fedora")
+        xpng.type("<tab>")
+        xpng.type("fedora")
     xpng.wait("user_created", 10)
     xpng.type(["<alt>", "d"])
-    time.sleep(1)
+    wait_until_stable(xpng)
     xpng.type(["<alt>", "d"])
     xpng.wait(["user_completed", "user_completed_white"], 10)
     print "User account created."
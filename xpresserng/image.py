@@ -18,6 +18,8 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
 
+from vncdotool.sprite import drawSprite
+
 DEFAULT_SIMILARITY = 0.98
 
 
@@ -43,6 +45,14 @@ class Image(object):
         When not specified, (0, 0) is assumed, which means click in the
         center of the image itself.
 
+    @ivar pyramid_min_size: Templates with a side shorter than this are
+        matched at full resolution only, even in pyramid mode.  None means
+        the default of the image finder.
+
+    @ivar region: (x, y, width, height) part of the screen where the image
+        shows up, only that is searched.  Float values are fractions of the
+        screen width or height.  None means the whole screen.
+
     @ivar width: The width of the image.
 
     @ivar height: The height of the image.
@@ -56,7 +66,8 @@ class Image(object):
     """
 
     def __init__(self, name=None, similarity=None, focus_delta=None,
-                 width=None, height=None, filename=None, array=None):
+                 width=None, height=None, filename=None, array=None,
+                 pyramid_min_size=None, region=None):
         if similarity is None:
             similarity = DEFAULT_SIMILARITY
         if focus_delta is None:
@@ -68,6 +79,8 @@ class Image(object):
         self.name = name
         self.similarity = similarity
         self.focus_delta = focus_delta
+        self.pyramid_min_size = pyramid_min_size
+        self.region = region
         self.width = width
         self.height = height
         self.filename = filename
@@ -82,4 +95,37 @@ class Image(object):
         return "unknown image"
 
     def __repr__(self):
-        return self.__str__()
\ No newline at end of file
+        return self.__str__()
+
+
+class Screenshot(Image):
+    """Image of the screen of the target machine.
+
+    @ivar frame_id: Id of the framebuffer frame the screenshot was taken from.
+
+    @ivar dirty_since: Id of the frame the dirty rectangles are relative to.
+
+    @ivar dirty: List of (x, y, width, height) rectangles which have changed
+        since the frame dirty_since.  None means the whole screen has to be
+        considered changed.
+
+    @ivar levels: (blue, green, red) maximal channel values of the colour
+        depth the screen was captured in, None for 8 bits per channel.
+
+    @ivar cursor: (x, y, image, mask) of the mouse pointer, which is not
+        part of array, or None.  Image is a BGR array, mask a boolean one.
+    """
+
+    def __init__(self, array, frame_id=None, dirty_since=None, dirty=None, levels=None,
+                 cursor=None):
+        super(Screenshot, self).__init__("screenshot", array=array,
+                                         width=len(array[0]), height=len(array))
+        self.frame_id = frame_id
+        self.dirty_since = dirty_since
+        self.dirty = dirty
+        self.levels = levels
+        self.cursor = cursor
+
+    def composited(self):
+        """Return the screen as seen by the user, with the mouse pointer."""
+        return drawSprite(self.array, self.cursor)
@@ -28,6 +28,8 @@ from xpresserng.image import Image
 
 
 CLICK_POSITION_RE = re.compile(r"^\s*(?P<x>[-+][0-9]+)\s+(?P<y>[-+][0-9]+)\s*$")
+REGION_RE = re.compile(r"^\s*([0-9]+(?:\.[0-9]*)?)\s+([0-9]+(?:\.[0-9]*)?)"
+                       r"\s+([0-9]+(?:\.[0-9]*)?)\s+([0-9]+(?:\.[0-9]*)?)\s*$")
 
 
 class ImageDirError(XpresserngError):
@@ -93,10 +95,35 @@ class ImageDir(object):
                                              int(match.group("y")))
                     except ConfigParser.NoOptionError:
                         image_focus_delta = None
+
+                    try:
+                        image_pyramid_min_size = config.getint(section_name,
+                                                               "pyramid_min_size")
+                    except ConfigParser.NoOptionError:
+                        image_pyramid_min_size = None
+                    except ValueError:
+                        value = config.get(section_name, "pyramid_min_size")
+                        raise ImageDirError("Image %s has bad pyramid_min_size: "
+                                            "%s" % (image_name, value))
+
+                    try:
+                        value = config.get(section_name, "region")
+                        match = REGION_RE.match(value)
+                        if not match:
+                            raise ImageDirError("Image %s has invalid region: %s"
+                                                % (image_name, value))
+                        # "0.5" is half of the screen, "512" pixels
+                        image_region = tuple(float(number) if "." in number
+                                             else int(number)
+                                             for number in match.groups())
+                    except ConfigParser.NoOptionError:
+                        image_region = None
                     image = Image(name=image_name,
                                   filename=image_filename,
                                   similarity=image_similarity,
-                                  focus_delta=image_focus_delta)
+                                  focus_delta=image_focus_delta,
+                                  pyramid_min_size=image_pyramid_min_size,
+                                  region=image_region)
                     self._images[image_name] = image
                     loaded_filenames.add(image_filename)
 
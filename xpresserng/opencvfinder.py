@@ -23,20 +23,266 @@
 #TODO: is find_all for anything usable?
 #TODO: make find_all
 
+import json
 import cv2
+import numpy
 from xpresserng.imagematch import ImageMatch
 import logging
 
 
+def merge_areas(areas):
+    """Merge overlapping (x, y, width, height) areas into their bounding boxes.
+
+    >>> merge_areas([(0, 0, 10, 10), (5, 5, 10, 10), (50, 50, 5, 5)])
+    [(0, 0, 15, 15), (50, 50, 5, 5)]
+    >>> merge_areas([(0, 0, 10, 10), (20, 0, 10, 10), (5, 0, 20, 5)])
+    [(0, 0, 30, 10)]
+
+    """
+    merged = []
+    for area in areas:
+        x0, y0, x1, y1 = area[0], area[1], area[0] + area[2], area[1] + area[3]
+        overlapping = True
+        while overlapping:
+            overlapping = False
+            for other in merged:
+                if other[0] < x1 and x0 < other[2] and other[1] < y1 and y0 < other[3]:
+                    merged.remove(other)
+                    x0, y0 = min(x0, other[0]), min(y0, other[1])
+                    x1, y1 = max(x1, other[2]), max(y1, other[3])
+                    overlapping = True
+                    break
+        merged.append((x0, y0, x1, y1))
+    return [(x0, y0, x1 - x0, y1 - y0) for x0, y0, x1, y1 in merged]
+
+
+def resolve_region(region, width, height):
+    """Return (x, y, width, height) region clipped to screen of given size.
+
+    Float values are fractions of screen width or height, ints are pixels.
+    None means the whole screen.
+
+    >>> resolve_region((0.5, 0.75, 1.0, 0.25), 1024, 768)
+    (512, 576, 512, 192)
+    >>> resolve_region((900, -10, 200, 100), 1024, 768)
+    (900, 0, 124, 90)
+    >>> resolve_region(None, 1024, 768)
+    (0, 0, 1024, 768)
+
+    """
+    if region is None:
+        return 0, 0, width, height
+    x, y, w, h = [int(round(value * size)) if isinstance(value, float) else value
+                  for value, size in zip(region, (width, height, width, height))]
+    x0, y0 = max(0, x), max(0, y)
+    x1, y1 = min(width, x + w), min(height, y + h)
+    return x0, y0, max(0, x1 - x0), max(0, y1 - y0)
+
+
+def quantize(array, levels):
+    """Reduce colours of BGR array the way a VNC server does for lower depths.
+
+    Levels are the maximal values of blue, green and red channels; servers
+    such as QEMU truncate values to them (v >> 3 for 5 bits), the client
+    scales them back to 0-255.
+
+    >>> quantize(numpy.array([[[0, 100, 255]]], numpy.uint8), (31, 63, 31))
+    array([[[  0, 101, 255]]], dtype=uint8)
+    >>> quantize(numpy.array([[[7, 3, 246]]], numpy.uint8), (31, 63, 31))
+    array([[[  0,   0, 247]]], dtype=uint8)
+
+    """
+    values = numpy.arange(256)
+    quantized = numpy.empty_like(array)
+    for channel, level in enumerate(levels):
+        table = (values * (level + 1) // 256 * 255 + level // 2) // level
+        quantized[..., channel] = table.astype(numpy.uint8)[array[..., channel]]
+    return quantized
+
+
+# templates whose smaller side is under this many pixels are not matched
+# on the coarse level of the pyramid
+PYRAMID_MIN_SIZE = 24
+# how many pyramid levels (halvings) at most, keeping the smaller side of
+# the coarse template at least PYRAMID_COARSE_SIZE pixels
+PYRAMID_LEVELS = 2
+PYRAMID_COARSE_SIZE = 12
+# candidates taken from the coarse level and verified at full resolution
+PYRAMID_CANDIDATES = 32
+# coarse grayscale matches score lower than full colour ones; candidates
+# have to reach similarity lowered by this much
+PYRAMID_MARGIN = 0.15
+# verified positions this close to the best one are ties, e.g. in flat
+# content, where rounding decides which one wins
+PYRAMID_TIE = 1e-4
+# matches on the coarse level have a standard deviation of at most this
+# many times more or less than the coarse template
+PYRAMID_CONTRAST = 2.0
+# most frequent positions of an image which are searched first
+PRIOR_POSITIONS = 3
+# distinct positions remembered per image
+PRIOR_HISTORY = 10
+# pixels around a remembered position searched for the image
+PRIOR_MARGIN = 8
+# matches at remembered positions are taken only when at least this similar,
+# weaker ones may have a better match elsewhere
+PRIOR_SIMILARITY = 0.995
+# full resolution matching splits areas into at most this many strips of
+# at least STRIP_ROWS positions each, matched in parallel with an executor
+STRIPS = 8
+STRIP_ROWS = 64
+
+
+def shrink(array, levels):
+    """Return grayscale of BGR array downscaled levels times by two.
+
+    Pixels are averaged, which keeps the edges of the array intact unlike
+    pyrDown; rows and columns which do not fill a whole pixel are dropped.
+    """
+    scale = 1 << levels
+    height, width = len(array) // scale, len(array[0]) // scale
+    return cv2.resize(cv2.cvtColor(array[:height * scale, :width * scale], cv2.COLOR_BGR2GRAY),
+                      (width, height), interpolation=cv2.INTER_AREA)
+
+
+def window_deviation(array, height, width):
+    """Return standard deviation of every height x width window of array.
+
+    Element (y, x) is that of array[y:y + height, x:x + width], as in the
+    result of cv2.matchTemplate.
+
+    >>> window_deviation(numpy.array([[0, 0, 2], [0, 0, 2]], numpy.uint8), 2, 2)
+    array([[0., 1.]])
+
+    """
+    count = float(height * width)
+    sums, squares = cv2.integral2(array, sdepth=cv2.CV_64F)
+
+    def windows(table):
+        return (table[height:, width:] - table[:-height, width:] -
+                table[height:, :-width] + table[:-height, :-width])
+    mean = windows(sums) / count
+    return numpy.sqrt(numpy.maximum(windows(squares) / count - mean * mean, 0))
+
+
 class OpenCVFinder(object):
-    def find(self, screen_image, area_image):
-        resultloc, resultval = self._find(screen_image, area_image)
+    """Finds images on the screen with OpenCV template matching.
+
+    In pyramid mode the screen and template are first matched in grayscale
+    and downscaled, then only the best few candidates of about the contrast
+    of the template are matched at full resolution in small windows around
+    them. When several positions match equally well, the area is matched at
+    full resolution as a whole, so the same one is found as without pyramid
+    mode. Templates smaller than pyramid_min_size (Image.pyramid_min_size
+    when set) on either side, or flat when downscaled, are always matched
+    at full resolution.
+
+    Positions where named images were found are remembered and searched
+    first, see load_positions.  The best match there is taken when it is
+    nearly exact (PRIOR_SIMILARITY), otherwise the usual search follows.
+    An image shown exactly at several places at once is thus found where
+    it was seen most often, not where full search would find it first.
+
+    Areas are matched at full resolution in horizontal strips (STRIPS).
+    With an executor (anything with submit returning a future, e.g.
+    concurrent.futures.ThreadPoolExecutor) the strips of an area, or the
+    images of find_any, are matched in parallel; OpenCV releases the GIL
+    while matching.  Strips are the same with or without an executor,
+    caches are filled before work is submitted and results are reduced in
+    a fixed order, so the executor does not change what is found.
+    """
+
+    def __init__(self, pyramid=False, pyramid_min_size=PYRAMID_MIN_SIZE, executor=None):
+        self.pyramid = pyramid
+        self.pyramid_min_size = pyramid_min_size
+        self.executor = executor
+        # image name -> {(x, y): times found there}
+        self.positions = {}
+        self.prior_hits = 0
+        self.prior_lookups = 0
+
+    def load_positions(self, filename):
+        """Load positions of images found in previous runs from JSON file."""
+        with open(filename) as f:
+            for name, positions in json.load(f).iteritems():
+                history = self.positions.setdefault(name, {})
+                for x, y, count in positions:
+                    history[(x, y)] = history.get((x, y), 0) + count
+
+    def save_positions(self, filename):
+        """Save positions of found images to JSON file, see load_positions."""
+        data = dict((name, sorted([x, y, count] for (x, y), count in history.iteritems()))
+                    for name, history in self.positions.iteritems())
+        with open(filename, "w") as f:
+            json.dump(data, f, sort_keys=True)
+
+    def prior_stats(self):
+        """Return how many of the finds of images with known positions were
+        found at one of them and how many finds there were."""
+        return self.prior_hits, self.prior_lookups
+
+    def find(self, screen_image, area_image, region=None):
+        """Return ImageMatch of area_image on screen_image, or None.
+
+        Only region (x, y, width, height) of the screen is searched, by
+        default Image.region of area_image, see resolve_region.
+        """
+        resultloc, resultval = self._find(screen_image, area_image, region)
         if resultloc is None or resultval is None:
             return None
         else:
             return ImageMatch(area_image, resultloc[0], resultloc[1], resultval)
 
-    def _load_image(self, image):
+    def find_any(self, screen_image, area_images, best=False, region=None):
+        """Return ImageMatch of one of area_images on screen_image, or None.
+
+        The screen is loaded and downscaled once for all of them.  Each
+        image is first looked for at its known positions, only then are
+        they searched for in their whole regions, in the given order.  The
+        first match is returned, with best the most similar one.  Image of
+        the match tells which one was found.
+        """
+        source = self._load_image(screen_image)
+        candidates = []
+        for area_image in area_images:
+            prepared = self._prepare(source, screen_image, area_image, region)
+            if prepared is not None:
+                candidates.append((area_image,) + prepared)
+        matches = []
+        for area_image, template, area in candidates:
+            loc, val = self._find_prior(source, area_image, template, area)
+            if loc is not None:
+                self._found(area_image, loc, True)
+                matches.append(ImageMatch(area_image, loc[0], loc[1], val))
+                if not best:
+                    return matches[0]
+        found = [match.image for match in matches]
+        candidates = [candidate for candidate in candidates
+                      if not any(candidate[0] is image for image in found)]
+        if self.executor is not None and len(candidates) > 1:
+            # workers only read the caches, so fill them here first
+            for area_image, template, area in candidates:
+                self._warm(screen_image, area_image, source, template, area)
+            # their strips are matched in the worker, waiting for other
+            # workers there could starve the executor
+            futures = [self.executor.submit(self._search, screen_image, area_image, source,
+                                            template, area, False)
+                       for area_image, template, area in candidates]
+            results = (future.result() for future in futures)
+        else:
+            results = (self._search(screen_image, area_image, source, template, area)
+                       for area_image, template, area in candidates)
+        for (area_image, template, area), (loc, val) in zip(candidates, results):
+            if self._searched(screen_image, area_image, source, area, loc, val):
+                matches.append(ImageMatch(area_image, loc[0], loc[1], val))
+                if not best:
+                    return matches[0]
+        if not matches:
+            return None
+        # max keeps the first of equally similar ones
+        return max(matches, key=lambda match: match.similarity)
+
+    def _load_image(self, image, levels=None):
         if "opencv_image" not in image.cache:
             if image.filename is not None:
                 opencv_image = cv2.imread(image.filename)
@@ -47,21 +293,288 @@ class OpenCVFinder(object):
             image.cache["opencv_image"] = opencv_image
             image.width = len(opencv_image[0])
             image.height = len(opencv_image)
-        return image.cache["opencv_image"]
+        if levels is None:
+            return image.cache["opencv_image"]
+        # screen has fewer colours, template has to lose them too
+        key = ("opencv_image", levels)
+        if key not in image.cache:
+            image.cache[key] = quantize(image.cache["opencv_image"], levels)
+        return image.cache[key]
 
-    def _find(self, screen_image, area_image):
+    def _search_areas(self, screen_image, area_image, source, template, region):
+        """Return list of (x, y, width, height) areas of region to search in.
+
+        When template was not found in the frame the dirty rectangles of the
+        screenshot are relative to, it can only appear where the screen has
+        changed since, so only those rectangles grown by template size are
+        searched.
+        """
+        height, width = source.shape[:2]
+        theight, twidth = template.shape[:2]
+        last_searched = area_image.cache.get("searched_frame")
+        dirty = getattr(screen_image, "dirty", None)
+        if dirty is None or last_searched != (screen_image.dirty_since, source.shape, region):
+            return [region]
+
+        rx, ry, rwidth, rheight = region
+        areas = []
+        for x, y, w, h in dirty:
+            x0, y0 = max(rx, x - twidth + 1), max(ry, y - theight + 1)
+            x1 = min(rx + rwidth, x + w + twidth - 1)
+            y1 = min(ry + rheight, y + h + theight - 1)
+            if x1 - x0 >= twidth and y1 - y0 >= theight:
+                areas.append((x0, y0, x1 - x0, y1 - y0))
+        return merge_areas(areas)
+
+    def _find(self, screen_image, area_image, region=None):
         source = self._load_image(screen_image)
-        template = self._load_image(area_image)
-        if len(source) <= 400 and len(source[0]) <= 720:
-            logging.debug("skipping broken image")
+        prepared = self._prepare(source, screen_image, area_image, region)
+        if prepared is None:
+            return None, None
+        template, region = prepared
+        resultloc, resultval = self._find_prior(source, area_image, template, region)
+        if resultloc is not None:
+            self._found(area_image, resultloc, True)
+            return resultloc, resultval
+        return self._find_full(screen_image, area_image, source, template, region)
+
+    def _prepare(self, source, screen_image, area_image, region):
+        """Return template and region to search in, None when it cannot fit."""
+        template = self._load_image(area_image, getattr(screen_image, "levels", None))
+        if region is None:
+            region = getattr(area_image, "region", None)
+        region = resolve_region(region, len(source[0]), len(source))
+        if region[3] < len(template) or region[2] < len(template[0]):
+            # e.g. text mode screen during boot
+            logging.debug("screen region %s smaller than %s", region, area_image)
+            return None
+        return template, region
+
+    def _find_full(self, screen_image, area_image, source, template, region):
+        """Search for template in the (dirty areas of) region of source."""
+        loc, val = self._search(screen_image, area_image, source, template, region)
+        if self._searched(screen_image, area_image, source, region, loc, val):
+            return loc, val
+        return None, None
+
+    def _search(self, screen_image, area_image, source, template, region, parallel=True):
+        """Return best position and value of template in region of source.
+
+        Parallel tells strips may be matched on the executor.
+        """
+        colors = getattr(screen_image, "levels", None)
+        rx, ry, rwidth, rheight = region
+        # everything below works on the region only, shifted to its origin
+        view = source[ry:ry + rheight, rx:rx + rwidth]
+        areas = self._search_areas(screen_image, area_image, source, template, region)
+        levels = self._pyramid_levels(area_image, template, colors)
+        resultloc, resultval = None, None
+        for x, y, width, height in areas:
+            if levels:
+                loc, val = self._match_pyramid(screen_image, area_image, view, region, template,
+                                               levels, colors, x - rx, y - ry, width, height,
+                                               parallel)
+            else:
+                loc, val = self._match_strips(view, template, x - rx, y - ry, width, height,
+                                              parallel)
+            if val is not None and (resultval is None or val > resultval):
+                resultloc, resultval = (loc[0] + rx, loc[1] + ry), val
+        return resultloc, resultval
+
+    def _warm(self, screen_image, area_image, source, template, region):
+        """Fill the caches _search of template in region of source uses."""
+        levels = self._pyramid_levels(area_image, template, getattr(screen_image, "levels", None))
+        if levels:
+            rx, ry, rwidth, rheight = region
+            self._coarse(screen_image, source[ry:ry + rheight, rx:rx + rwidth], levels, region)
+
+    def _searched(self, screen_image, area_image, source, region, loc, val):
+        """Note result of _search, return whether the image was found."""
+        if val is not None and area_image.similarity <= val:
+            self._found(area_image, loc, False)
+            return True
+        if getattr(screen_image, "frame_id", None) is not None:
+            area_image.cache["searched_frame"] = (screen_image.frame_id, source.shape, region)
+        return False
+
+    def _found(self, area_image, position, prior):
+        area_image.cache.pop("searched_frame", None)
+        self._remember(area_image, position, prior)
+
+    def _find_prior(self, source, area_image, template, region):
+        """Return best nearly exact match around most frequent positions."""
+        history = self.positions.get(area_image.name)
+        if not history:
             return None, None
+        rx, ry, rwidth, rheight = region
+        theight, twidth = template.shape[:2]
+        likely = sorted(history.iteritems(), key=lambda (position, count): (-count, position))
+        resultloc, resultval = None, None
+        for (x, y), count in likely[:PRIOR_POSITIONS]:
+            x0, y0 = max(rx, x - PRIOR_MARGIN), max(ry, y - PRIOR_MARGIN)
+            x1 = min(rx + rwidth, x + twidth + PRIOR_MARGIN)
+            y1 = min(ry + rheight, y + theight + PRIOR_MARGIN)
+            loc, val = self._match(source, template, x0, y0, x1 - x0, y1 - y0)
+            if val is not None and (resultval is None or val > resultval):
+                resultloc, resultval = loc, val
+        if resultval is not None and max(area_image.similarity, PRIOR_SIMILARITY) <= resultval:
+            return resultloc, resultval
+        return None, None
+
+    def _remember(self, area_image, position, prior):
+        """Count position of found image, prior tells it was found there first."""
+        if area_image.name is None:
+            return
+        history = self.positions.setdefault(area_image.name, {})
+        if history:
+            self.prior_lookups += 1
+            self.prior_hits += prior
+        history[position] = history.get(position, 0) + 1
+        if len(history) > PRIOR_HISTORY:
+            # forget the least frequent, the newest one survives
+            del history[min((count, xy) for xy, count in history.iteritems()
+                            if xy != position)[1]]
+
+    def _match(self, source, template, x, y, width, height):
+        """Return best position and value of template in area of source."""
         try:
-            match = cv2.matchTemplate(source, template, cv2.TM_CCOEFF_NORMED)
+            match = cv2.matchTemplate(source[y:y + height, x:x + width], template,
+                                      cv2.TM_CCOEFF_NORMED)
         except: # because of opencv assertion error (matrix.cpp:115)
             return None, None
         # do I have to normalize?
         minval, maxval, minloc, maxloc = cv2.minMaxLoc(match)
-        if area_image.similarity <= maxval:
-            return maxloc, maxval
+        return (x + maxloc[0], y + maxloc[1]), maxval
+
+    def _match_strips(self, source, template, x, y, width, height, parallel=True):
+        """Like _match, matching horizontal strips of the area.
+
+        Strips overlap by template height - 1 rows, so every position is in
+        exactly one of them.  They depend on the area only, with parallel
+        they are matched on the executor.  Ties go to the upper strip.
+        """
+        rows = height - len(template) + 1
+        count = max(1, min(STRIPS, rows // STRIP_ROWS))
+        if count == 1:
+            return self._match(source, template, x, y, width, height)
+        bounds = [rows * i // count for i in xrange(count + 1)]
+        strips = [(source, template, x, y + start, width, end - start + len(template) - 1)
+                  for start, end in zip(bounds, bounds[1:])]
+        if parallel and self.executor is not None:
+            futures = [self.executor.submit(self._match, *strip) for strip in strips]
+            results = (future.result() for future in futures)
         else:
-            return None, None
\ No newline at end of file
+            results = (self._match(*strip) for strip in strips)
+        resultloc, resultval = None, None
+        for loc, val in results:
+            if val is not None and (resultval is None or val > resultval):
+                resultloc, resultval = loc, val
+        return resultloc, resultval
+
+    def _match_ties(self, source, template, x, y, width, height):
+        """Like _match, also return how many positions tie with the best."""
+        try:
+            match = cv2.matchTemplate(source[y:y + height, x:x + width], template,
+                                      cv2.TM_CCOEFF_NORMED)
+        except: # because of opencv assertion error (matrix.cpp:115)
+            return None, None, 0
+        minval, maxval, minloc, maxloc = cv2.minMaxLoc(match)
+        ties = numpy.count_nonzero(match >= maxval - PYRAMID_TIE)
+        return (x + maxloc[0], y + maxloc[1]), maxval, ties
+
+    def _pyramid_levels(self, area_image, template, colors):
+        """Return number of coarse levels to match template on, 0 for none."""
+        if not self.pyramid:
+            return 0
+        min_size = getattr(area_image, "pyramid_min_size", None) or self.pyramid_min_size
+        size = min(template.shape[:2])
+        if size < min_size:
+            return 0
+        levels = 0
+        while levels < PYRAMID_LEVELS and size >> (levels + 1) >= PYRAMID_COARSE_SIZE:
+            levels += 1
+        if levels and min(phase.std() for phase in
+                          self._coarse_template(area_image, template, levels, colors)) < 1:
+            # flat templates have no correlation to speak of
+            return 0
+        return levels
+
+    def _coarse(self, image, array, levels, variant=None):
+        """Return grayscale array downscaled levels times, cached in image.
+
+        Variant tells apart arrays of one image, e.g. region of a screen.
+        """
+        key = ("pyramid", variant, levels)
+        if key not in image.cache:
+            image.cache[key] = shrink(array, levels)
+        return image.cache[key]
+
+    def _coarse_template(self, area_image, template, levels, colors):
+        """Return coarse templates for every phase, see _coarse.
+
+        Fine details average out differently depending on where in the
+        downscaled pixels the template starts, so there is one coarse
+        template for each (x, y) offset, in the order of numpy.ndindex.
+        All have the same size.
+        """
+        key = ("pyramid", colors, levels)
+        if key not in area_image.cache:
+            scale = 1 << levels
+            height = (len(template) - scale + 1) // scale * scale
+            width = (len(template[0]) - scale + 1) // scale * scale
+            area_image.cache[key] = [shrink(template[dy:dy + height, dx:dx + width], levels)
+                                     for dy, dx in numpy.ndindex(scale, scale)]
+        return area_image.cache[key]
+
+    def _match_pyramid(self, screen_image, area_image, source, region, template, levels,
+                       colors, x, y, width, height, parallel=True):
+        """Like _match_strips, but verify only best candidates of the coarse level.
+
+        Source is the region of screen_image.
+        """
+        scale = 1 << levels
+        coarse_source = self._coarse(screen_image, source, levels, region)
+        phases = self._coarse_template(area_image, template, levels, colors)
+        theight, twidth = phases[0].shape
+        cx0, cy0 = x // scale, y // scale
+        cx1 = min(len(coarse_source[0]), (x + width) // scale)
+        cy1 = min(len(coarse_source), (y + height) // scale)
+        if cx1 - cx0 < twidth or cy1 - cy0 < theight:
+            return self._match_strips(source, template, x, y, width, height, parallel)
+        # position of the best phase is at most scale - 1 pixels after the
+        # template, which the verification window covers
+        match = None
+        for phase in phases:
+            phase_match = cv2.matchTemplate(coarse_source[cy0:cy1, cx0:cx1], phase,
+                                            cv2.TM_CCOEFF_NORMED)
+            match = phase_match if match is None else numpy.maximum(match, phase_match)
+        # a match has about the contrast of the template, windows of other
+        # contrast only correlate with its shapes
+        deviation = window_deviation(coarse_source[cy0:cy1, cx0:cx1], theight, twidth)
+        contrast = [phase.std() for phase in phases]
+        match[(deviation < min(contrast) / PYRAMID_CONTRAST) |
+              (deviation > max(contrast) * PYRAMID_CONTRAST)] = -1
+        threshold = area_image.similarity - PYRAMID_MARGIN
+        resultloc, resultval = None, None
+        found = 0
+        for _ in xrange(PYRAMID_CANDIDATES):
+            minval, maxval, minloc, maxloc = cv2.minMaxLoc(match)
+            if not maxval >= threshold:
+                break
+            mx, my = maxloc
+            # the window verifies these positions, nothing else is skipped
+            match[max(0, my - 1):my + 2, max(0, mx - 1):mx + 2] = -1
+            wx0 = max(x, (cx0 + mx - 1) * scale)
+            wy0 = max(y, (cy0 + my - 1) * scale)
+            wx1 = min(x + width, (cx0 + mx + 1) * scale + len(template[0]))
+            wy1 = min(y + height, (cy0 + my + 1) * scale + len(template))
+            loc, val, ties = self._match_ties(source, template, wx0, wy0, wx1 - wx0, wy1 - wy0)
+            if val is not None and val >= area_image.similarity:
+                found += ties
+            if val is not None and (resultval is None or val > resultval):
+                resultloc, resultval = loc, val
+        if found > 1:
+            # several positions are it, e.g. in repeated or flat content;
+            # which one wins is up to a full match
+            return self._match_strips(source, template, x, y, width, height, parallel)
+        return resultloc, resultval
@@ -11,15 +11,31 @@ import math
 import operator
 import time
 import logging
+from collections import deque
 
-from twisted.internet.defer import Deferred
+import numpy
+from twisted.internet.defer import Deferred, succeed
 from twisted.internet import reactor
 
 import rfb
+from sprite import drawSprite
 
 
 log = logging.getLogger('client')
 
+# number of frames for which updated rectangles are remembered
+DAMAGE_HISTORY = 64
+
+# true colour pixel formats by bits per pixel, all BGR(X) in memory
+PIXEL_FORMATS = {
+    32: dict(bpp=32, depth=24, redmax=255, greenmax=255, bluemax=255,
+             redshift=16, greenshift=8, blueshift=0),
+    16: dict(bpp=16, depth=16, redmax=31, greenmax=63, bluemax=31,
+             redshift=11, greenshift=5, blueshift=0),
+    8: dict(bpp=8, depth=8, redmax=7, greenmax=7, bluemax=3,
+            redshift=5, greenshift=2, blueshift=0),
+}
+
 
 KEYMAP = {
     'bsp': rfb.KEY_BackSpace,
@@ -105,6 +121,17 @@ KEYMAP = {
 }
 
 
+def asarray(data):
+    """ Return uint8 numpy array sharing memory with string, buffer or
+    memoryview data, numpy arrays are returned as they are.
+    """
+    if isinstance(data, numpy.ndarray):
+        return data
+    if isinstance(data, memoryview):
+        return numpy.asarray(data)
+    return numpy.frombuffer(data, numpy.uint8)
+
+
 def ImageFactory():
     """ Wrap importing PIL.Image so vncdotool can be used without
     PIL being installed.  Of course capture and expect won't work
@@ -118,12 +145,29 @@ class VNCDoToolClient(rfb.RFBClient):
     x = 0
     y = 0
     buttons = 0
-    screen = None
+    framebuffer = None
+    shared = False
     deferred = None
 
+    updating = False
+    committed = False
+    frame_id = 0
+    first_frame_id = 0  # frame_id before the first frame of this connection
+    frame_time = None
+    resized = False
+    resizing = 0    # 2 new size announced, 1 waiting for the whole screen
+    continuous = False
+    continuousSupported = False
+
     cursor = None
     cmask = None
 
+    _input = None
+
+    def __init__(self):
+        rfb.RFBClient.__init__(self)
+        self.damage = deque(maxlen=DAMAGE_HISTORY)
+
     def _decodeKey(self, key):
         if len(key) == 1:
             keys = [key]
@@ -135,10 +179,52 @@ class VNCDoToolClient(rfb.RFBClient):
         return keys
 
     def pause(self, duration):
+        d = self.flushInput()
+        d.addCallback(lambda _: self._sleep(duration))
+        return d
+
+    def _sleep(self, duration):
         d = Deferred()
         reactor.callLater(duration, d.callback, self)
         return d
 
+    def bufferInput(self):
+        """ Collect key and pointer events until flushInput(), which sends
+            them in one write
+        """
+        if self._input is None:
+            self._input = []
+        return self
+
+    def sendInput(self, message):
+        if self._input is None:
+            self.transport.write(message)
+        else:
+            self._input.append(message)
+
+    def flushInput(self):
+        """ Send buffered input events, all at once or factory.pacing
+            seconds apart. Return deferred fired once all are sent
+        """
+        messages, self._input = self._input, None
+        if not messages:
+            return succeed(self)
+
+        if not self.factory.pacing:
+            self.transport.write(''.join(messages))
+            return succeed(self)
+
+        d = Deferred()
+        self._writePaced(messages, d)
+        return d
+
+    def _writePaced(self, messages, d):
+        self.transport.write(messages[0])
+        if len(messages) > 1:
+            reactor.callLater(self.factory.pacing, self._writePaced, messages[1:], d)
+        else:
+            d.callback(self)
+
     def keyPress(self, key):
         """ Send a key press to the server
 
@@ -206,12 +292,10 @@ class VNCDoToolClient(rfb.RFBClient):
     def captureScreen(self, filename):
         """ Save the current display to filename
         """
-        # request screen update
         log.debug('captureScreen', filename)
-        self.framebufferUpdateRequest()
-        self.deferred = Deferred()
-        self.deferred.addCallback(self._captureSave, filename)
-        return self.deferred
+        d = self._requestFrame()
+        d.addCallback(self._captureSave, filename)
+        return d
 
     def _captureSave(self, data, filename):
         log.debug('captureDone', filename)
@@ -219,6 +303,23 @@ class VNCDoToolClient(rfb.RFBClient):
 
         return self
 
+    def captureFrame(self):
+        """ Return the current display as BGR numpy array
+
+            With 32 bit pixels the array is a view of the framebuffer, which
+            is copied before the next update changes it, so it must not be
+            modified. Lower depths are expanded to BGR.
+        """
+        log.debug('captureFrame')
+        d = self._requestFrame()
+        d.addCallback(self._captureArray)
+        return d
+
+    def _captureArray(self, data):
+        if self.bypp == 4:
+            self.shared = True
+        return self._toBGR(self.framebuffer)
+
     def expectScreen(self, filename, maxrms=0):
         """ Wait until the display matches a target image
 
@@ -227,15 +328,14 @@ class VNCDoToolClient(rfb.RFBClient):
                     screen and target image
         """
         log.debug('expectScreen', filename)
-        self.framebufferUpdateRequest()
         self.expected = ImageFactory().open(filename).histogram()
-        self.deferred = Deferred()
-        self.deferred.addCallback(self._expectCompare, maxrms)
+        d = self._requestFrame()
+        d.addCallback(self._expectCompare, maxrms)
 
-        return self.deferred
+        return d
 
-    def _expectCompare(self, image, maxrms):
-        hist = image.histogram()
+    def _expectCompare(self, data, maxrms):
+        hist = self.screen.histogram()
         if len(hist) == len(self.expected):
             rms = math.sqrt(
                         reduce(operator.add, map(lambda a, b: (a - b) ** 2,
@@ -245,10 +345,63 @@ class VNCDoToolClient(rfb.RFBClient):
             if rms <= maxrms:
                 return self
 
-        self.deferred = Deferred()
-        self.deferred.addCallback(self._expectCompare, maxrms)
-        self.framebufferUpdateRequest(incremental=1)
+        d = self._requestFrame(incremental=1)
+        d.addCallback(self._expectCompare, maxrms)
+
+        return d
+
+    def dirtySince(self, frame_id):
+        """ Return list of (x, y, w, h) rectangles updated after frame_id
+
+            None means everything has to be considered updated, also for
+            frame ids of another connection.
+        """
+        if frame_id is None or frame_id < self.frame_id - len(self.damage):
+            return None
+        if frame_id < self.first_frame_id or frame_id > self.frame_id:
+            return None
+
+        dirty = []
+        for damaged_id, damaged_time, rectangles in self.damage:
+            if damaged_id > frame_id:
+                if rectangles is None:
+                    return None
+                dirty.extend(rectangles)
+        return dirty
+
+    def lastChange(self, region=None):
+        """ Return commit time of the newest update inside region (x, y,
+            w, h), the whole screen when None. None when there was none
+
+            Updates older than the damage history count as committed with
+            its oldest frame.
+        """
+        for damaged_id, damaged_time, rectangles in reversed(self.damage):
+            if rectangles is None:
+                return damaged_time
+            for x, y, w, h in rectangles:
+                if region is None or (x < region[0] + region[2] and region[0] < x + w and
+                                      y < region[1] + region[3] and region[1] < y + h):
+                    return damaged_time
+        if len(self.damage) == self.damage.maxlen:
+            return self.damage[0][1]
+        return None
+
+    def _requestFrame(self, incremental=0):
+        """ Return deferred fired once the framebuffer holds a complete frame
+
+            incremental: wait for the next update instead of the current
+                         frame
+        """
+        # the frame should show what buffered input did
+        self.flushInput()
+        if not self.factory.incremental:
+            self.framebufferUpdateRequest(incremental=incremental)
+        elif not incremental and self.committed and not self.updating and not self.resizing:
+            # the framebuffer is kept current, no need to ask the server
+            return succeed(self)
 
+        self.deferred = Deferred()
         return self.deferred
 
     def mouseMove(self, x, y):
@@ -288,13 +441,76 @@ class VNCDoToolClient(rfb.RFBClient):
     #
     # base customizations
     #
+    def setPixelFormat(self, bpp=32, depth=24, bigendian=0, truecolor=1,
+                       redmax=255, greenmax=255, bluemax=255,
+                       redshift=16, greenshift=8, blueshift=0):
+        # BGRX byte order, framebuffer pixels are OpenCV's BGR as they are
+        rfb.RFBClient.setPixelFormat(self, bpp, depth, bigendian, truecolor,
+                                     redmax, greenmax, bluemax,
+                                     redshift, greenshift, blueshift)
+        if self.bypp < 4:
+            # lookup table expanding every possible pixel value to BGR
+            values = numpy.arange(1 << bpp)
+            channels = [(((values >> shift) & cmax) * 255 + cmax // 2) // cmax
+                        for shift, cmax in ((blueshift, bluemax), (greenshift, greenmax),
+                                            (redshift, redmax))]
+            self._bgr = numpy.column_stack(channels).astype(numpy.uint8)
+            self._pixel = numpy.dtype('u%d' % self.bypp).newbyteorder('>' if bigendian else '<')
+
+    def _toBGR(self, pixels):
+        """ Convert (height, width, bypp) array of pixels to BGR, a view
+            for 32 bit pixels
+        """
+        if self.bypp == 4:
+            return pixels[:, :, :3]
+        return self._bgr[pixels.view(self._pixel)[:, :, 0]]
+
     def vncConnectionMade(self):
-        self.setPixelFormat()
-        encodings = [rfb.RAW_ENCODING]
+        self.setPixelFormat(**PIXEL_FORMATS[self.factory.bpp])
+        self._growFramebuffer(self.width, self.height)
+        self.setEncodings(self._encodings())
+        if self.factory.incremental:
+            self.framebufferUpdateRequest()
+        self.factory.clientConnectionMade(self)
+
+    def _encodings(self):
+        if self.factory.quality is None and self.factory.compression is None:
+            encodings = [rfb.ZRLE_ENCODING, rfb.TIGHT_ENCODING, rfb.RAW_ENCODING]
+        else:
+            # tuned Tight is the cheapest on slow links
+            encodings = [rfb.TIGHT_ENCODING, rfb.ZRLE_ENCODING, rfb.RAW_ENCODING]
+        encodings.append(rfb.COPY_RECTANGLE_ENCODING)
+        if self.factory.compression is not None:
+            encodings.append(rfb.PSEUDO_COMPRESSION_LEVEL_ENCODING + self.factory.compression)
+        # without a quality level Tight stays lossless
+        if self.factory.quality is not None:
+            encodings.append(rfb.PSEUDO_QUALITY_LEVEL_ENCODING + self.factory.quality)
         if self.factory.pseudocusor or self.factory.nocursor:
             encodings.append(rfb.PSEUDO_CURSOR_ENCODING)
-        self.setEncodings(encodings)
-        self.factory.clientConnectionMade(self)
+        encodings.extend([rfb.PSEUDO_EXTENDED_DESKTOP_SIZE_ENCODING,
+                          rfb.PSEUDO_DESKTOP_SIZE_ENCODING])
+        if self.factory.incremental:
+            # let servers push updates without waiting for requests
+            encodings.extend([rfb.PSEUDO_CONTINUOUS_UPDATES_ENCODING,
+                              rfb.PSEUDO_FENCE_ENCODING])
+        return encodings
+
+    def setQuality(self, quality=None, compression=None):
+        """ Renegotiate Tight JPEG quality and zlib compression level
+
+            quality: int: [0-9], None for lossless updates
+            compression: int: [0-9], None for server default
+        """
+        log.debug('setQuality %s %s', quality, compression)
+        lossy = self.factory.quality is not None
+        self.factory.quality = quality
+        self.factory.compression = compression
+        self.setEncodings(self._encodings())
+        if lossy and quality is None:
+            # replace lossy pixels already in the framebuffer
+            self.framebufferUpdateRequest()
+
+        return self
 
     def bell(self):
         print 'ding'
@@ -306,28 +522,122 @@ class VNCDoToolClient(rfb.RFBClient):
         self.clientCutText(message)
         return self
 
+    @property
+    def screen(self):
+        """ The display as PIL image, cursor included
+        """
+        if self.framebuffer is None:
+            return None
+
+        bgr = self.drawCursor(self._toBGR(self.framebuffer))
+        rgb = numpy.ascontiguousarray(bgr[:, :, ::-1])
+        screen = ImageFactory().fromarray(rgb, 'RGB')
+        return screen
+
+    def _growFramebuffer(self, width, height):
+        if self.framebuffer is None:
+            self.framebuffer = numpy.zeros((height, width, self.bypp), numpy.uint8)
+            return
+
+        fbheight, fbwidth = self.framebuffer.shape[:2]
+        if fbwidth < width or fbheight < height:
+            framebuffer = numpy.zeros((max(fbheight, height), max(fbwidth, width), self.bypp),
+                                      numpy.uint8)
+            framebuffer[:fbheight, :fbwidth] = self.framebuffer
+            self.framebuffer = framebuffer
+            self.resized = True
+
     def updateRectangle(self, x, y, width, height, data):
         # ignore empty updates
-        if not data:
+        if not width or not height:
             return
 
-        size = (width, height)
-        update = ImageFactory().fromstring('RGB', size, data, 'raw', 'RGBX')
-        if not self.screen:
-            self.screen = update
-        # track upward screen resizes, often occurs during os boot of VMs
-        elif self.screen.size[0] < width or self.screen.size[1] < height:
-            self.screen = update
-        else:
-            self.screen.paste(update, (x, y))
+        # servers without DesktopSize resize the screen silently
+        self._growFramebuffer(x + width, y + height)
+        pixels = asarray(data).reshape(height, width, self.bypp)
+        self.framebuffer[y:y + height, x:x + width] = pixels
+
+    def fillRectangle(self, x, y, width, height, color):
+        if not width or not height:
+            return
+
+        self._growFramebuffer(x + width, y + height)
+        self.framebuffer[y:y + height, x:x + width] = asarray(color)
 
-        self.drawCursor()
+    def copyRectangle(self, srcx, srcy, x, y, width, height):
+        if not width or not height:
+            return
+
+        self._growFramebuffer(x + width, y + height)
+        pixels = self.framebuffer[srcy:srcy + height, srcx:srcx + width]
+        # scrolling copies a rectangle over itself, do not read what
+        # was already overwritten
+        if abs(srcx - x) < width and abs(srcy - y) < height:
+            pixels = pixels.copy()
+        self.framebuffer[y:y + height, x:x + width] = pixels
+
+    def desktopResized(self, width, height):
+        log.debug('desktopResized %s %s', width, height)
+        self.framebuffer = numpy.zeros((height, width, self.bypp), numpy.uint8)
+        self.shared = False
+        self.resized = True
+        # frames are not complete until the whole new screen arrives
+        self.resizing = 2
+        if self.continuous:
+            self.enableContinuousUpdates()
+        self.factory.desktopResized(self, width, height)
+
+    def endOfContinuousUpdates(self):
+        if not self.continuousSupported:
+            # servers announce support with the first one
+            self.continuousSupported = True
+            if self.factory.incremental:
+                log.debug('enabling continuous updates')
+                self.continuous = True
+                self.enableContinuousUpdates()
+        elif self.continuous:
+            log.debug('continuous updates ended by server')
+            self.continuous = False
+            self.framebufferUpdateRequest(incremental=1)
+
+    def connectionLost(self, reason):
+        if self.deferred:
+            d = self.deferred
+            self.deferred = None
+            d.errback(reason)
+
+    def beginUpdate(self):
+        self.updating = True
+        if self.shared:
+            # captured frames keep the old framebuffer
+            self.framebuffer = self.framebuffer.copy()
+            self.shared = False
 
     def commitUpdate(self, rectangles):
+        self.updating = False
+        if self.resizing == 2:
+            # this update announced a new size, ask for the whole screen
+            self.resizing = 1
+            self.framebufferUpdateRequest()
+            return
+        self.resizing = 0
+        self.committed = True
+        self.frame_id += 1
+        self.frame_time = time.time()
+        if self.resized:
+            self.damage.append((self.frame_id, self.frame_time, None))
+            self.resized = False
+        else:
+            self.damage.append((self.frame_id, self.frame_time, list(rectangles)))
+        self.factory.frameCommitted(self)
+        if self.factory.incremental and not self.continuous:
+            # keep the framebuffer current, server answers once anything changes
+            self.framebufferUpdateRequest(incremental=1)
+
         if self.deferred:
             d = self.deferred
             self.deferred = None
-            d.callback(self.screen)
+            d.callback(self)
 
     def updateCursor(self, x, y, width, height, image, mask):
         if self.factory.nocursor:
@@ -335,22 +645,28 @@ class VNCDoToolClient(rfb.RFBClient):
 
         if not width or not height:
             self.cursor = None
+            return
 
-        self.cursor = ImageFactory().fromstring('RGBX', (width, height), image)
-        self.cmask = ImageFactory().fromstring('1', (width, height), mask)
+        # new arrays every time, sprites handed out stay unchanged
+        self.cursor = numpy.array(self._toBGR(asarray(image).reshape(height, width, self.bypp)))
+        rowbytes = (width + 7) // 8
+        bits = numpy.unpackbits(asarray(mask).reshape(height, rowbytes), axis=1)
+        self.cmask = bits[:, :width].astype(bool)
         self.cfocus = x, y
-        self.drawCursor()
 
-    def drawCursor(self):
-        if not self.cursor:
-            return
+    def cursorSprite(self):
+        """ Return (x, y, image, mask) of the cursor drawn client-side,
+            image is BGR and mask boolean numpy array, or None
+        """
+        if self.cursor is None:
+            return None
 
-        if not self.screen:
-            return
+        return (self.x - self.cfocus[0], self.y - self.cfocus[1], self.cursor, self.cmask)
 
-        x = self.x - self.cfocus[0]
-        y = self.y - self.cfocus[1]
-        self.screen.paste(self.cursor, (x, y), self.cmask)
+    def drawCursor(self, frame):
+        """ Return BGR frame with the cursor drawn in, see drawSprite
+        """
+        return drawSprite(frame, self.cursorSprite())
 
     def vncRequestPassword(self):
         if self.factory.password is None:
@@ -367,6 +683,11 @@ class VNCDoToolFactory(rfb.RFBFactory):
 
     pseudocusor = False
     nocursor = False
+    incremental = False
+    quality = None
+    compression = None
+    bpp = 32
+    pacing = 0
 
     def __init__(self):
         self.deferred = Deferred()
@@ -378,3 +699,11 @@ class VNCDoToolFactory(rfb.RFBFactory):
     def clientConnectionMade(self, protocol):
         self.deferred.callback(protocol)
         self.deferred = None
+
+    def desktopResized(self, protocol, width, height):
+        """ Called when the screen changes resolution
+        """
+
+    def frameCommitted(self, protocol):
+        """ Called after every framebuffer update, see protocol.frame_id
+        """
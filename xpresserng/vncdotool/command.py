@@ -83,35 +83,35 @@ class VNCDoToolOptionParser(optparse.OptionParser):
         return result
 
 
-def build_command_list(factory, args, delay=None, warp=1.0):
+def build_command_list(deferred, args, delay=None, warp=1.0):
     client = VNCDoToolClient
 
     while args:
         cmd = args.pop(0)
         if cmd == 'key':
             key = args.pop(0)
-            factory.deferred.addCallback(client.keyPress, key)
+            deferred.addCallback(client.keyPress, key)
         elif cmd in ('kdown', 'keydown'):
             key = args.pop(0)
-            factory.deferred.addCallback(client.keyDown, key)
+            deferred.addCallback(client.keyDown, key)
         elif cmd in ('kup', 'keyup'):
             key = args.pop(0)
-            factory.deferred.addCallback(client.keyUp, key)
+            deferred.addCallback(client.keyUp, key)
         elif cmd in ('move', 'mousemove'):
             x, y = int(args.pop(0)), int(args.pop(0))
-            factory.deferred.addCallback(client.mouseMove, x, y)
+            deferred.addCallback(client.mouseMove, x, y)
         elif cmd == 'click':
             button = int(args.pop(0))
-            factory.deferred.addCallback(client.mousePress, button)
+            deferred.addCallback(client.mousePress, button)
         elif cmd in ('mdown', 'mousedown'):
             button = int(args.pop(0))
-            factory.deferred.addCallback(client.mouseDown, button)
+            deferred.addCallback(client.mouseDown, button)
         elif cmd in ('mup', 'mouseup'):
             button = int(args.pop(0))
-            factory.deferred.addCallback(client.mouseUp, button)
+            deferred.addCallback(client.mouseUp, button)
         elif cmd == 'type':
             for key in args.pop(0):
-                factory.deferred.addCallback(client.keyPress, key)
+                deferred.addCallback(client.keyPress, key)
         elif cmd == 'capture':
             filename = args.pop(0)
             imgformat = os.path.splitext(filename)[1][1:]
@@ -119,17 +119,17 @@ def build_command_list(factory, args, delay=None, warp=1.0):
                 print 'unsupported image format "%s", choose one of %s' % (
                         imgformat, SUPPORTED_FORMATS)
             else:
-                factory.deferred.addCallback(client.captureScreen, filename)
+                deferred.addCallback(client.captureScreen, filename)
         elif cmd == 'expect':
             filename = args.pop(0)
             rms = int(args.pop(0))
-            factory.deferred.addCallback(client.expectScreen, filename, rms)
+            deferred.addCallback(client.expectScreen, filename, rms)
         elif cmd in ('pause', 'sleep'):
             duration = float(args.pop(0)) / warp
-            factory.deferred.addCallback(client.pause, duration)
+            deferred.addCallback(client.pause, duration)
         elif cmd in 'drag':
             x, y = int(args.pop(0)), int(args.pop(0))
-            factory.deferred.addCallback(client.mouseDrag, x, y)
+            deferred.addCallback(client.mouseDrag, x, y)
         elif os.path.isfile(cmd):
             lex = shlex.shlex(open(cmd), posix=True)
             lex.whitespace_split = True
@@ -138,7 +138,7 @@ def build_command_list(factory, args, delay=None, warp=1.0):
             print 'unknown cmd "%s"' % cmd
 
         if delay and args:
-            factory.deferred.addCallback(client.pause, float(delay) / 1000)
+            deferred.addCallback(client.pause, float(delay) / 1000)
 
 
 def build_tool(options, args):
@@ -151,7 +151,7 @@ def build_tool(options, args):
         lex.whitespace_split = True
         args = list(lex)
 
-    build_command_list(factory, args, options.delay, options.warp)
+    build_command_list(factory.deferred, args, options.delay, options.warp)
 
     factory.deferred.addCallback(stop)
     factory.deferred.addErrback(error)
@@ -228,6 +228,11 @@ class VNCLoggingServerFactory(portforward.ProxyFactory):
     shared = True
     pseudocusor = False
     nocursor = False
+    incremental = False
+    quality = None
+    compression = None
+    bpp = 32
+    pacing = 0
 
     output = sys.stdout
     _out = None
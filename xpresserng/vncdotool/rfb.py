@@ -14,7 +14,10 @@ MIT License
 
 import sys
 import math
+import zlib
 from struct import pack, unpack
+
+import numpy
 from twisted.python import usage, log
 from twisted.internet.protocol import Protocol
 from twisted.internet import protocol
@@ -38,6 +41,19 @@ ZLIBHEX_ENCODING =              8
 ZRLE_ENCODING =                 16
 #0xffffff00 to 0xffffffff tight options
 PSEUDO_CURSOR_ENCODING =        -239
+PSEUDO_DESKTOP_SIZE_ENCODING =  -223
+PSEUDO_EXTENDED_DESKTOP_SIZE_ENCODING = -308
+PSEUDO_FENCE_ENCODING =         -312
+PSEUDO_CONTINUOUS_UPDATES_ENCODING = -313
+
+#flags of Fence messages
+FENCE_BLOCK_BEFORE =            1 << 0
+FENCE_BLOCK_AFTER =             1 << 1
+FENCE_SYNC_NEXT =               1 << 2
+FENCE_REQUEST =                 1 << 31
+#plus level 0-9
+PSEUDO_QUALITY_LEVEL_ENCODING = -32
+PSEUDO_COMPRESSION_LEVEL_ENCODING = -256
 
 #keycodes
 #for KeyEvent()
@@ -114,9 +130,11 @@ KEY_SpaceBar=   0x0020
 class RFBClient(Protocol):
 
     def __init__(self):
-        self._packet = []
-        self._packet_len = 0
+        self._buffer = bytearray()
+        self._offset = 0
         self._handler = self._handleInitial
+        self._zrle_stream = zlib.decompressobj()
+        self._tight_streams = [zlib.decompressobj() for i in range(4)]
         self._already_expecting = 0
 
     #------------------------------------------------------
@@ -124,24 +142,19 @@ class RFBClient(Protocol):
     #------------------------------------------------------
 
     def _handleInitial(self):
-        buffer = ''.join(self._packet)
+        buffer = self._buffer
         if '\n' in buffer:
             if buffer[:3] == 'RFB':
                 #~ print "rfb"
-                maj, min = [int(x) for x in buffer[3:-1].split('.')]
+                maj, min = [int(x) for x in str(buffer[3:11]).split('.')]
                 #~ print maj, min
                 if (maj, min) not in [(3,3), (3,7), (3,8), (4,0)]:
                     log.msg("wrong protocol version\n")
                     self.transport.loseConnection()
-            buffer = buffer[12:]
+            self._buffer = buffer[12:]
             self.transport.write('RFB 003.003\n')
-            self._packet[:] = [buffer]
-            self._packet_len = len(buffer)
             self._handler = self._handleExpected
             self.expect(self._handleAuth, 4)
-        else:
-            self._packet[:] = [buffer]
-            self._packet_len = len(buffer)
 
     def _handleAuth(self, block):
         (auth,) = unpack("!I", block)
@@ -161,10 +174,10 @@ class RFBClient(Protocol):
         self.expect(self._handleConnMessage, waitfor)
 
     def _handleConnMessage(self, block):
-        log.msg("Connection refused: %r" % block)
+        log.msg("Connection refused: %r" % block.tobytes())
 
     def _handleVNCAuth(self, block):
-        self._challenge = block
+        self._challenge = block.tobytes()
         self.vncRequestPassword()
         self.expect(self._handleVNCAuthResult, 4)
 
@@ -204,7 +217,7 @@ class RFBClient(Protocol):
         self.expect(self._handleServerName, namelen)
 
     def _handleServerName(self, block):
-        self.name = block
+        self.name = block.tobytes()
         #callback:
         self.vncConnectionMade()
         self.expect(self._handleConnection, 1)
@@ -221,6 +234,11 @@ class RFBClient(Protocol):
             self.expect(self._handleConnection, 1)
         elif msgid == 3:
             self.expect(self._handleServerCutText, 7)
+        elif msgid == 150:
+            self.endOfContinuousUpdates()
+            self.expect(self._handleConnection, 1)
+        elif msgid == 248:
+            self.expect(self._handleServerFence, 8)
         else:
             log.msg("unknown message received (id %d)" % msgid)
             self.expect(self._handleConnection, 1)
@@ -242,19 +260,26 @@ class RFBClient(Protocol):
         (x, y, width, height, encoding) = unpack("!HHHHi", block)
         if self.rectangles:
             self.rectangles -= 1
-            self.rectanglePos.append( (x, y, width, height) )
+            if encoding >= 0:   # pseudo encodings do not change pixels
+                self.rectanglePos.append( (x, y, width, height) )
             if encoding == COPY_RECTANGLE_ENCODING:
                 self.expect(self._handleDecodeCopyrect, 4, x, y, width, height)
             elif encoding == RAW_ENCODING:
                 self.expect(self._handleDecodeRAW, width*height*self.bypp, x, y, width, height)
             elif encoding == HEXTILE_ENCODING:
-                self._doNextHextileSubrect(None, None, x, y, width, height, None, None)
+                self.peek(self._handleScanHextile, 1, x, y, width, height, 0, 0, 0)
             elif encoding == CORRE_ENCODING:
                 self.expect(self._handleDecodeCORRE, 4 + self.bypp, x, y, width, height)
             elif encoding == RRE_ENCODING:
                 self.expect(self._handleDecodeRRE, 4 + self.bypp, x, y, width, height)
-            #~ elif encoding == ZRLE_ENCODING:
-                #~ self.expect(self._handleDecodeZRLE, )
+            elif encoding == ZRLE_ENCODING:
+                self.expect(self._handleDecodeZRLE, 4, x, y, width, height)
+            elif encoding == TIGHT_ENCODING:
+                self.expect(self._handleDecodeTight, 1, x, y, width, height)
+            elif encoding == PSEUDO_DESKTOP_SIZE_ENCODING:
+                self._handleDesktopSize(width, height)
+            elif encoding == PSEUDO_EXTENDED_DESKTOP_SIZE_ENCODING:
+                self.expect(self._handleExtendedDesktopSize, 4, x, y, width, height)
             elif encoding == PSEUDO_CURSOR_ENCODING:
                 length = width * height * self.bypp
                 length += int(math.floor((width + 7.0) / 8)) * height
@@ -283,167 +308,402 @@ class RFBClient(Protocol):
 
     def _handleDecodeRRE(self, block, x, y, width, height):
         (subrects,) = unpack("!I", block[:4])
-        color = block[4:]
-        self.fillRectangle(x, y, width, height, color)
+        color = block[4:].tobytes()
         if subrects:
-            self.expect(self._handleRRESubRectangles, (8 + self.bypp) * subrects, x, y)
+            self.expect(self._handleRRESubRectangles, (8 + self.bypp) * subrects, x, y, width, height, color)
         else:
+            self.fillRectangle(x, y, width, height, color)
             self._doConnection()
 
-    def _handleRRESubRectangles(self, block, topx, topy):
-        #~ print "_handleRRESubRectangle"
-        pos = 0
-        end = len(block)
-        sz  = self.bypp + 8
-        format = "!%dsHHHH" % self.bypp
-        while pos < end:
-            (color, x, y, width, height) = unpack(format, block[pos:pos+sz])
-            self.fillRectangle(topx + x, topy + y, width, height, color)
-            pos += sz
+    def _handleRRESubRectangles(self, block, x, y, width, height, color):
+        self._decodeSubrects(block, 2, x, y, width, height, color)
         self._doConnection()
 
     # ---  CoRRE Encoding
 
     def _handleDecodeCORRE(self, block, x, y, width, height):
         (subrects,) = unpack("!I", block[:4])
-        color = block[4:]
-        self.fillRectangle(x, y, width, height, color)
+        color = block[4:].tobytes()
         if subrects:
-            self.expect(self._handleDecodeCORRERectangles, (4 + self.bypp)*subrects, x, y)
+            self.expect(self._handleDecodeCORRERectangles, (4 + self.bypp) * subrects, x, y, width, height, color)
         else:
+            self.fillRectangle(x, y, width, height, color)
             self._doConnection()
 
-    def _handleDecodeCORRERectangles(self, block, topx, topy):
-        #~ print "_handleDecodeCORRERectangle"
-        pos = 0
-        end = len(block)
-        sz  = self.bypp + 4
-        format = "!%dsBBBB" % self.bypp
-        while pos < sz:
-            (color, x, y, width, height) = unpack(format, block[pos:pos+sz])
-            self.fillRectangle(topx + x, topy + y, width, height, color)
-            pos += sz
+    def _handleDecodeCORRERectangles(self, block, x, y, width, height, color):
+        self._decodeSubrects(block, 1, x, y, width, height, color)
         self._doConnection()
 
-    # ---  Hexile Encoding
+    def _decodeSubrects(self, block, size, x, y, width, height, background):
+        """paint all subrects, each a PIXEL followed by x, y, width and
+           height of size bytes, over the background and update the
+           rectangle at once"""
+        records = numpy.asarray(block).reshape(-1, self.bypp + 4 * size)
+        colors = records[:, :self.bypp]
+        coords = records[:, self.bypp:].copy().view('>u%d' % size).tolist()
+        pixels = numpy.empty((height, width, self.bypp), numpy.uint8)
+        pixels[...] = numpy.frombuffer(background, numpy.uint8)
+        for (sx, sy, sw, sh), color in zip(coords, colors):
+            pixels[sy:sy + sh, sx:sx + sw] = color
+        self.updateRectangle(x, y, width, height, pixels)
 
-    def _doNextHextileSubrect(self, bg, color, x, y, width, height, tx, ty):
-        #~ print "_doNextHextileSubrect %r" % ((color, x, y, width, height, tx, ty), )
-        #coords of next tile
-        #its line after line of tiles
-        #finished when the last line is completly received
+    # ---  Hexile Encoding
 
-        #dont inc the first time
-        if tx is not None:
-            #calc next subrect pos
+    def _handleScanHextile(self, view, x, y, width, height, tx, ty, pos):
+        """find where the hextile rectangle ends, resuming at tile (tx, ty)
+           which starts pos bytes into the rectangle, and expect all of it
+           for the decoder"""
+        available = len(view)
+        while ty < height:
+            if pos >= available:
+                self.peek(self._handleScanHextile, pos + 1, x, y, width, height, tx, ty, pos)
+                return
+            subencoding = ord(view[pos])
+            tw = min(16, width - tx)
+            if subencoding & 1:     #RAW
+                size = 1 + tw * min(16, height - ty) * self.bypp
+            else:
+                size = 1
+                if subencoding & 2:     #BackgroundSpecified
+                    size += self.bypp
+                if subencoding & 4:     #ForegroundSpecified
+                    size += self.bypp
+                if subencoding & 8:     #AnySubrects
+                    if pos + size >= available:
+                        self.peek(self._handleScanHextile, pos + size + 1, x, y, width, height, tx, ty, pos)
+                        return
+                    subrects = ord(view[pos + size])
+                    if subencoding & 16:    #SubrectsColoured
+                        size += 1 + subrects * (self.bypp + 2)
+                    else:
+                        size += 1 + subrects * 2
+            pos += size
             tx += 16
-            if tx >= x + width:
-                tx = x
+            if tx >= width:
+                tx = 0
                 ty += 16
+        self.expect(self._handleDecodeHextile, pos, x, y, width, height)
+
+    def _handleDecodeHextile(self, block, x, y, width, height):
+        """decode all tiles of the rectangle in one pass"""
+        bypp = self.bypp
+        data = bytearray(block)
+        array = numpy.frombuffer(data, numpy.uint8)
+        pixels = numpy.empty((height, width, bypp), numpy.uint8)
+        bg = color = None
+        pos = 0
+        for ty in xrange(0, height, 16):
+            th = min(16, height - ty)
+            for tx in xrange(0, width, 16):
+                tw = min(16, width - tx)
+                tile = pixels[ty:ty + th, tx:tx + tw]
+                subencoding = data[pos]
+                pos += 1
+                if subencoding & 1:     #RAW
+                    end = pos + tw * th * bypp
+                    tile[...] = array[pos:end].reshape(th, tw, bypp)
+                    pos = end
+                    continue
+                if subencoding & 2:     #BackgroundSpecified
+                    bg = array[pos:pos + bypp]
+                    pos += bypp
+                tile[...] = bg
+                if subencoding & 4:     #ForegroundSpecified
+                    color = array[pos:pos + bypp]
+                    pos += bypp
+                if subencoding & 8:     #AnySubrects
+                    subrects = data[pos]
+                    pos += 1
+                    coloured = subencoding & 16
+                    for i in xrange(subrects):
+                        if coloured:    #SubrectsColoured
+                            color = array[pos:pos + bypp]
+                            pos += bypp
+                        xy = data[pos]
+                        wh = data[pos + 1]
+                        pos += 2
+                        sx = xy >> 4
+                        sy = xy & 0xf
+                        tile[sy:sy + (wh & 0xf) + 1, sx:sx + (wh >> 4) + 1] = color
+        self.updateRectangle(x, y, width, height, pixels)
+        self._doConnection()
+
+    # ---  ZRLE Encoding
+
+    def _cpixelFormat(self):
+        """return size of CPIXEL and offset of its bytes within a PIXEL"""
+        if self.truecolor and self.bpp == 32 and self.depth <= 24:
+            used = ((self.redmax << self.redshift) | (self.greenmax << self.greenshift) |
+                    (self.bluemax << self.blueshift))
+            if used < (1 << 24):        # least significant 3 bytes
+                return 3, (1 if self.bigendian else 0)
+            if not used & 0xff:         # most significant 3 bytes
+                return 3, (0 if self.bigendian else 1)
+        return self.bypp, 0
+
+    def _cpixelsToPixels(self, data, cpixel):
+        """expand uint8 array of CPIXELs to (n, bypp) array of PIXELs"""
+        size, offset = cpixel
+        if size == self.bypp:
+            return data.reshape(-1, self.bypp)
+        pixels = numpy.zeros((len(data) // size, self.bypp), numpy.uint8)
+        pixels[:, offset:offset + size] = data.reshape(-1, size)
+        return pixels
+
+    def _handleDecodeZRLE(self, block, x, y, width, height):
+        (length,) = unpack("!I", block)
+        self.expect(self._handleDecodeZRLEData, length, x, y, width, height)
+
+    def _handleDecodeZRLEData(self, block, x, y, width, height):
+        # the zlib stream continues over all ZRLE rectangles of the connection
+        data = self._zrle_stream.decompress(block.tobytes())
+        array = numpy.frombuffer(data, numpy.uint8)
+        data = bytearray(data)
+        cpixel = self._cpixelFormat()
+        cpp = cpixel[0]
+        pos = 0
+        for ty in xrange(y, y + height, 64):
+            th = min(64, y + height - ty)
+            for tx in xrange(x, x + width, 64):
+                tw = min(64, x + width - tx)
+                subencoding = data[pos]
+                pos += 1
+                if subencoding == 0:            # raw CPIXELs
+                    end = pos + tw * th * cpp
+                    pixels = self._cpixelsToPixels(array[pos:end], cpixel)
+                    self.updateRectangle(tx, ty, tw, th, pixels.reshape(th, tw, self.bypp))
+                    pos = end
+                elif subencoding == 1:          # solid tile
+                    color = self._cpixelsToPixels(array[pos:pos + cpp], cpixel)
+                    self.fillRectangle(tx, ty, tw, th, color.tostring())
+                    pos += cpp
+                elif subencoding <= 16:         # packed palette
+                    end = pos + subencoding * cpp
+                    palette = self._cpixelsToPixels(array[pos:end], cpixel)
+                    pos = end
+                    bits = 1 if subencoding == 2 else (2 if subencoding <= 4 else 4)
+                    rowbytes = (tw * bits + 7) // 8
+                    end = pos + rowbytes * th
+                    packed = numpy.unpackbits(array[pos:end].reshape(th, rowbytes), axis=1)
+                    weights = 1 << numpy.arange(bits - 1, -1, -1)
+                    indices = packed.reshape(th, -1, bits).dot(weights)[:, :tw]
+                    self.updateRectangle(tx, ty, tw, th, palette[indices])
+                    pos = end
+                elif subencoding == 128 or subencoding >= 130:  # run-length
+                    if subencoding >= 130:
+                        end = pos + (subencoding - 128) * cpp
+                        palette = self._cpixelsToPixels(array[pos:end], cpixel)
+                        pos = end
+                    colors = []
+                    runs = []
+                    left = tw * th
+                    while left > 0:
+                        if subencoding == 128:
+                            colors.append(pos)
+                            pos += cpp
+                            run = True
+                        else:
+                            index = data[pos]
+                            pos += 1
+                            colors.append(index & 127)
+                            run = index & 128
+                        length = 1
+                        if run:
+                            while data[pos] == 255:
+                                length += 255
+                                pos += 1
+                            length += data[pos]
+                            pos += 1
+                        runs.append(length)
+                        left -= length
+                    if subencoding == 128:
+                        starts = numpy.array(colors)[:, numpy.newaxis] + numpy.arange(cpp)
+                        colors = self._cpixelsToPixels(array[starts].reshape(-1), cpixel)
+                    else:
+                        colors = palette[colors]
+                    pixels = numpy.repeat(colors, runs, axis=0)
+                    self.updateRectangle(tx, ty, tw, th, pixels.reshape(th, tw, self.bypp))
+                else:
+                    log.msg("unknown ZRLE subencoding %d" % subencoding)
+                    self.transport.loseConnection()
+                    return
+        self._doConnection()
+
+    # ---  Tight Encoding
+
+    def _rgbToPixels(self, rgb):
+        """convert (n, 3) uint8 array of RGB colors to (n, bypp) PIXELs"""
+        rgb = rgb.astype(numpy.uint32)
+        value = ((rgb[:, 0] * self.redmax + 127) // 255 << self.redshift |
+                 (rgb[:, 1] * self.greenmax + 127) // 255 << self.greenshift |
+                 (rgb[:, 2] * self.bluemax + 127) // 255 << self.blueshift)
+        dtype = numpy.dtype('u%d' % self.bypp).newbyteorder('>' if self.bigendian else '<')
+        return value.astype(dtype).view(numpy.uint8).reshape(-1, self.bypp)
+
+    def _tpixelSize(self):
+        """TPIXELs are RGB triplets in 24 bit true colour formats"""
+        if (self.truecolor and self.bpp == 32 and self.depth == 24 and
+                self.redmax == self.greenmax == self.bluemax == 255):
+            return 3
+        return self.bypp
+
+    def _tpixelsToPixels(self, data):
+        """convert uint8 array of TPIXELs to (n, bypp) array of PIXELs"""
+        if self._tpixelSize() == 3:
+            return self._rgbToPixels(data.reshape(-1, 3))
+        return data.reshape(-1, self.bypp)
+
+    def _expectCompactLength(self, handler, *args):
+        """read 1-3 bytes long compact representation of a length and
+           expect that many bytes for handler"""
+        self.expect(self._handleCompactLength, 1, 0, 0, handler, args)
+
+    def _handleCompactLength(self, block, length, shift, handler, args):
+        byte = ord(block[0])
+        if shift == 14:             # third byte uses all 8 bits
+            length |= byte << shift
         else:
-            tx = x
-            ty = y
-        #more tiles?
-        if ty >= y + height:
-            self._doConnection()
-        else:
-            self.expect(self._handleDecodeHextile, 1, bg, color, x, y, width, height, tx, ty)
-
-    def _handleDecodeHextile(self, block, bg, color, x, y, width, height, tx, ty):
-        (subencoding,) = unpack("!B", block)
-        #calc tile size
-        tw = th = 16
-        if x + width - tx < 16:   tw = x + width - tx
-        if y + height - ty < 16:  th = y + height- ty
-        #decode tile
-        if subencoding & 1:     #RAW
-            self.expect(self._handleDecodeHextileRAW, tw*th*self.bypp, bg, color, x, y, width, height, tx, ty, tw, th)
+            length |= (byte & 0x7f) << shift
+        if byte & 0x80 and shift < 14:
+            self.expect(self._handleCompactLength, 1, length, shift + 7, handler, args)
         else:
-            numbytes = 0
-            if subencoding & 2:     #BackgroundSpecified
-                numbytes += self.bypp
-            if subencoding & 4:     #ForegroundSpecified
-                numbytes += self.bypp
-            if subencoding & 8:     #AnySubrects
-                numbytes += 1
-            if numbytes:
-                self.expect(self._handleDecodeHextileSubrect, numbytes, subencoding, bg, color, x, y, width, height, tx, ty, tw, th)
+            self.expect(handler, length, *args)
+
+    def _handleDecodeTight(self, block, x, y, width, height):
+        control = ord(block[0])
+        for stream in range(4):
+            if control & (1 << stream):
+                self._tight_streams[stream] = zlib.decompressobj()
+        compression = control >> 4
+        if compression == 8:        # fill
+            self.expect(self._handleDecodeTightFill, self._tpixelSize(), x, y, width, height)
+        elif compression == 9:      # JPEG
+            self._expectCompactLength(self._handleDecodeTightJpeg, x, y, width, height)
+        elif compression < 8:       # basic
+            stream = compression & 3
+            if compression & 4:
+                self.expect(self._handleDecodeTightFilter, 1, stream, x, y, width, height)
             else:
-                self.fillRectangle(tx, ty, tw, th, bg)
-                self._doNextHextileSubrect(bg, color, x, y, width, height, tx, ty)
+                self._expectTightData(stream, None, x, y, width, height)
+        else:
+            log.msg("unknown Tight compression %d" % compression)
+            self.transport.loseConnection()
 
-    def _handleDecodeHextileSubrect(self, block, subencoding, bg, color, x, y, width, height, tx, ty, tw, th):
-        subrects = 0
-        pos = 0
-        if subencoding & 2:     #BackgroundSpecified
-            bg = block[:self.bypp]
-            pos += self.bypp
-        self.fillRectangle(tx, ty, tw, th, bg)
-        if subencoding & 4:     #ForegroundSpecified
-            color = block[pos:pos+self.bypp]
-            pos += self.bypp
-        if subencoding & 8:     #AnySubrects
-            #~ (subrects, ) = unpack("!B", block)
-            subrects = ord(block[pos])
-        #~ print subrects
-        if subrects:
-            if subencoding & 16:    #SubrectsColoured
-                self.expect(self._handleDecodeHextileSubrectsColoured, (self.bypp + 2)*subrects, bg, color, subrects, x, y, width, height, tx, ty, tw, th)
-            else:
-                self.expect(self._handleDecodeHextileSubrectsFG, 2*subrects, bg, color, subrects, x, y, width, height, tx, ty, tw, th)
+    def _handleDecodeTightFill(self, block, x, y, width, height):
+        color = self._tpixelsToPixels(numpy.asarray(block))
+        self.fillRectangle(x, y, width, height, color.tostring())
+        self._doConnection()
+
+    def _handleDecodeTightJpeg(self, block, x, y, width, height):
+        import cv2  # needed only when lossy Tight is negotiated
+        bgr = cv2.imdecode(numpy.asarray(block), cv2.IMREAD_COLOR)
+        pixels = self._rgbToPixels(bgr[:, :, ::-1].reshape(-1, 3))
+        self.updateRectangle(x, y, width, height, pixels.reshape(height, width, self.bypp))
+        self._doConnection()
+
+    def _handleDecodeTightFilter(self, block, stream, x, y, width, height):
+        tight_filter = ord(block[0])
+        if tight_filter == 1:       # palette
+            self.expect(self._handleDecodeTightPaletteSize, 1, stream, x, y, width, height)
+        elif tight_filter in (0, 2):  # copy, gradient
+            self._expectTightData(stream, tight_filter, x, y, width, height)
         else:
-            self._doNextHextileSubrect(bg, color, x, y, width, height, tx, ty)
+            log.msg("unknown Tight filter %d" % tight_filter)
+            self.transport.loseConnection()
 
+    def _handleDecodeTightPaletteSize(self, block, stream, x, y, width, height):
+        colors = ord(block[0]) + 1
+        self.expect(self._handleDecodeTightPalette, colors * self._tpixelSize(), stream, x, y, width, height)
 
-    def _handleDecodeHextileRAW(self, block, bg, color, x, y, width, height, tx, ty, tw, th):
-        """the tile is in raw encoding"""
-        self.updateRectangle(tx, ty, tw, th, block)
-        self._doNextHextileSubrect(bg, color, x, y, width, height, tx, ty)
+    def _handleDecodeTightPalette(self, block, stream, x, y, width, height):
+        palette = self._tpixelsToPixels(numpy.array(block))
+        self._expectTightData(stream, palette, x, y, width, height)
 
-    def _handleDecodeHextileSubrectsColoured(self, block, bg, color, subrects, x, y, width, height, tx, ty, tw, th):
-        """subrects with their own color"""
-        sz = self.bypp + 2
-        pos = 0
-        end = len(block)
-        while pos < end:
-            pos2 = pos + self.bypp
-            color = block[pos:pos2]
-            xy = ord(block[pos2])
-            wh = ord(block[pos2+1])
-            sx = xy >> 4
-            sy = xy & 0xf
-            sw = (wh >> 4) + 1
-            sh = (wh & 0xf) + 1
-            self.fillRectangle(tx + sx, ty + sy, sw, sh, color)
-            pos += sz
-        self._doNextHextileSubrect(bg, color, x, y, width, height, tx, ty)
-
-    def _handleDecodeHextileSubrectsFG(self, block, bg, color, subrects, x, y, width, height, tx, ty, tw, th):
-        """all subrect with same color"""
-        pos = 0
-        end = len(block)
-        while pos < end:
-            xy = ord(block[pos])
-            wh = ord(block[pos+1])
-            sx = xy >> 4
-            sy = xy & 0xf
-            sw = (wh >> 4) + 1
-            sh = (wh & 0xf) + 1
-            self.fillRectangle(tx + sx, ty + sy, sw, sh, color)
-            pos += 2
-        self._doNextHextileSubrect(bg, color, x, y, width, height, tx, ty)
+    def _expectTightData(self, stream, tight_filter, x, y, width, height):
+        """tight_filter is None/0 for copy, 2 for gradient or a palette"""
+        if isinstance(tight_filter, numpy.ndarray):
+            if len(tight_filter) == 2:
+                size = (width + 7) // 8 * height
+            else:
+                size = width * height
+        else:
+            size = width * height * self._tpixelSize()
+        if size < 12:
+            self.expect(self._handleDecodeTightData, size, None, tight_filter, x, y, width, height)
+        else:
+            self._expectCompactLength(self._handleDecodeTightData, stream, tight_filter, x, y, width, height)
 
+    def _handleDecodeTightData(self, block, stream, tight_filter, x, y, width, height):
+        if stream is None:
+            data = numpy.array(block)
+        else:
+            data = numpy.frombuffer(self._tight_streams[stream].decompress(block.tobytes()), numpy.uint8)
+        if isinstance(tight_filter, numpy.ndarray):
+            if len(tight_filter) == 2:
+                rowbytes = (width + 7) // 8
+                bits = numpy.unpackbits(data.reshape(height, rowbytes), axis=1)
+                indices = bits[:, :width]
+            else:
+                indices = data.reshape(height, width)
+            pixels = tight_filter[indices]
+        elif tight_filter == 2:
+            pixels = self._tightGradient(data, width, height)
+        else:
+            pixels = self._tpixelsToPixels(data)
+        self.updateRectangle(x, y, width, height, pixels.reshape(height, width, self.bypp))
+        self._doConnection()
 
-    # ---  ZRLE Encoding
+    def _tightGradient(self, data, width, height):
+        """undo the gradient filter, each color component was sent as
+           a difference from the prediction left + above - above left"""
+        if self._tpixelSize() == 3:
+            diffs = data.reshape(height, width, 3).astype(numpy.int32)
+            maxes = numpy.array([255, 255, 255])
+        else:
+            dtype = numpy.dtype('u%d' % self.bypp).newbyteorder('>' if self.bigendian else '<')
+            values = data.view(dtype).reshape(height, width, 1).astype(numpy.int32)
+            shifts = numpy.array([self.redshift, self.greenshift, self.blueshift])
+            maxes = numpy.array([self.redmax, self.greenmax, self.bluemax])
+            diffs = (values >> shifts) & maxes
+        colors = numpy.zeros((height + 1, width + 1, 3), numpy.int32)
+        # pixels on one anti-diagonal only depend on the two previous ones
+        for diagonal in xrange(height + width - 1):
+            rows = numpy.arange(max(0, diagonal - width + 1), min(diagonal, height - 1) + 1)
+            columns = diagonal - rows
+            prediction = colors[rows, columns + 1] + colors[rows + 1, columns] - colors[rows, columns]
+            prediction = numpy.clip(prediction, 0, maxes)
+            colors[rows + 1, columns + 1] = (prediction + diffs[rows, columns]) % (maxes + 1)
+        colors = colors[1:, 1:].reshape(-1, 3)
+        if self._tpixelSize() == 3:
+            return self._rgbToPixels(colors)
+        value = ((colors[:, 0] << self.redshift) | (colors[:, 1] << self.greenshift) |
+                 (colors[:, 2] << self.blueshift))
+        return value.astype(dtype).view(numpy.uint8).reshape(-1, self.bypp)
+
+    # --- DesktopSize and ExtendedDesktopSize Pseudo Encodings
+
+    def _handleDesktopSize(self, width, height):
+        self.width, self.height = width, height
+        self.desktopResized(width, height)
+        self._doConnection()
 
-    def _handleDecodeZRLE(self, block):
-        raise NotImplementedError
+    def _handleExtendedDesktopSize(self, block, reason, status, width, height):
+        (screens,) = unpack("!Bxxx", block)
+        self.expect(self._handleExtendedDesktopSizeScreens, 16 * screens, reason, status, width, height)
+
+    def _handleExtendedDesktopSizeScreens(self, block, reason, status, width, height):
+        #screen layout is not needed, status other than 0 refuses a resize
+        #requested by a client
+        if status == 0 and (width, height) != (self.width, self.height):
+            self._handleDesktopSize(width, height)
+        else:
+            self._doConnection()
 
     # --- Pseudo Cursor Encoding
     def _handleDecodePsuedoCursor(self, block, x, y, width, height):
         split = width * height * self.bypp
-        image = block[:split]
-        mask = block[split:]
+        image = block[:split].tobytes()
+        mask = block[split:].tobytes()
         self.updateCursor(x, y, width, height, image, mask)
         self._doConnection()
 
@@ -454,7 +714,20 @@ class RFBClient(Protocol):
         self.expect(self._handleServerCutTextValue, length)
 
     def _handleServerCutTextValue(self, block):
-        self.copy_text(block)
+        self.copy_text(block.tobytes())
+        self.expect(self._handleConnection, 1)
+
+    def _handleServerFence(self, block):
+        (flags, length) = unpack("!xxxIB", block)
+        self.expect(self._handleServerFencePayload, length, flags)
+
+    def _handleServerFencePayload(self, block, flags):
+        payload = block.tobytes()
+        if flags & FENCE_REQUEST:
+            # messages are handled in order, so the reply can go right away
+            self.fence(flags & (FENCE_BLOCK_BEFORE | FENCE_BLOCK_AFTER | FENCE_SYNC_NEXT), payload)
+        else:
+            self.fenceReceived(flags, payload)
         self.expect(self._handleConnection, 1)
 
     #------------------------------------------------------
@@ -462,21 +735,30 @@ class RFBClient(Protocol):
     #------------------------------------------------------
     def dataReceived(self, data):
         #~ sys.stdout.write(repr(data) + '\n')
-        #~ print len(data), ", ", len(self._packet)
-        self._packet.append(data)
-        self._packet_len += len(data)
+        #~ print len(data), ", ", len(self._buffer) - self._offset
+        self._buffer.extend(data)
         self._handler()
 
     def _handleExpected(self):
-        if self._packet_len >= self._expected_len:
-            buffer = ''.join(self._packet)
-            while len(buffer) >= self._expected_len:
-                self._already_expecting = 1
-                block, buffer = buffer[:self._expected_len], buffer[self._expected_len:]
+        """hand expected blocks to their handlers as memoryview slices of
+           the receive buffer, without copying the data"""
+        if len(self._buffer) - self._offset >= self._expected_len:
+            self._already_expecting = 1
+            view = memoryview(self._buffer)
+            while len(self._buffer) - self._offset >= self._expected_len:
+                start = self._offset
+                if self._expected_peek:
+                    self._expected_handler(view[start:], *self._expected_args, **self._expected_kwargs)
+                    continue
+                self._offset += self._expected_len
                 #~ log.msg("handle %r with %r\n" % (block, self._expected_handler.__name__))
-                self._expected_handler(block, *self._expected_args, **self._expected_kwargs)
-            self._packet[:] = [buffer]
-            self._packet_len = len(buffer)
+                self._expected_handler(view[start:self._offset], *self._expected_args, **self._expected_kwargs)
+            del view
+            # start a new buffer with the rest, blocks handed out stay valid;
+            # peeks hand out nothing, so keep growing the buffer after them
+            if self._offset:
+                self._buffer = self._buffer[self._offset:]
+                self._offset = 0
             self._already_expecting = 0
 
     def expect(self, handler, size, *args, **kwargs):
@@ -485,9 +767,22 @@ class RFBClient(Protocol):
         self._expected_len = size
         self._expected_args = args
         self._expected_kwargs = kwargs
+        self._expected_peek = False
         if not self._already_expecting:
             self._handleExpected()   #just in case that there is already enough data
 
+    def peek(self, handler, size, *args, **kwargs):
+        """like expect(), but handler gets everything received so far
+           without consuming it, so it can find out how long a message of
+           unknown size is. it must expect() or peek() for more data."""
+        self._expected_handler = handler
+        self._expected_len = size
+        self._expected_args = args
+        self._expected_kwargs = kwargs
+        self._expected_peek = True
+        if not self._already_expecting:
+            self._handleExpected()
+
     #------------------------------------------------------
     # client -> server messages
     #------------------------------------------------------
@@ -515,14 +810,32 @@ class RFBClient(Protocol):
     def keyEvent(self, key, down=1):
         """For most ordinary keys, the "keysym" is the same as the corresponding ASCII value.
         Other common keys are shown in the KEY_ constants."""
-        self.transport.write(pack("!BBxxI", 4, down, key))
+        self.sendInput(pack("!BBxxI", 4, down, key))
 
     def pointerEvent(self, x, y, buttonmask=0):
         """Indicates either pointer movement or a pointer button press or release. The pointer is
            now at (x-position, y-position), and the current state of buttons 1 to 8 are represented
            by bits 0 to 7 of button-mask respectively, 0 meaning up, 1 meaning down (pressed).
         """
-        self.transport.write(pack("!BBHH", 5, buttonmask, x, y))
+        self.sendInput(pack("!BBHH", 5, buttonmask, x, y))
+
+    def sendInput(self, message):
+        """send KeyEvent or PointerEvent message, override to buffer them"""
+        self.transport.write(message)
+
+    def enableContinuousUpdates(self, enable=1, x=0, y=0, width=None, height=None):
+        """Ask the server to send updates of the area as soon as it changes,
+           without FramebufferUpdateRequests. only for servers which sent
+           EndOfContinuousUpdates."""
+        if width  is None: width  = self.width - x
+        if height is None: height = self.height - y
+        self.transport.write(pack("!BBHHHH", 150, enable, x, y, width, height))
+
+    def fence(self, flags, payload=""):
+        """Send a Fence, with FENCE_REQUEST the server sends it back once
+           the messages before it are processed. payload has at most 64
+           bytes."""
+        self.transport.write(pack("!BxxxIB", 248, flags, len(payload)) + payload)
 
     def clientCutText(self, message):
         """The client has new ASCII text in its cut buffer.
@@ -565,8 +878,8 @@ class RFBClient(Protocol):
            rectangles."""
 
     def updateRectangle(self, x, y, width, height, data):
-        """new bitmap data. data is a string in the pixel format set
-           up earlier."""
+        """new bitmap data. data is a string, memoryview or (height, width,
+           bytes per pixel) numpy array in the pixel format set up earlier."""
 
     def copyRectangle(self, srcx, srcy, x, y, width, height):
         """used for copyrect encoding. copy the given rectangle
@@ -583,6 +896,18 @@ class RFBClient(Protocol):
         """ New cursor, focuses at (x, y)
         """
 
+    def endOfContinuousUpdates(self):
+        """the server supports continuous updates (first message) or has
+           stopped sending them."""
+
+    def fenceReceived(self, flags, payload):
+        """reply to a Fence sent by fence()"""
+
+    def desktopResized(self, width, height):
+        """the framebuffer has a new size. the server sends the
+           whole screen only when asked by a non-incremental
+           FramebufferUpdateRequest."""
+
     def bell(self):
         """bell"""
 
@@ -0,0 +1,23 @@
+"""
+Drawing of pointer sprites into frames, without Twisted
+
+MIT License
+"""
+
+
+def drawSprite(frame, sprite):
+    """ Return BGR frame with (x, y, image, mask) sprite drawn in, clipped
+    to the frame. The frame is copied unless nothing of sprite is visible.
+    """
+    if sprite is None:
+        return frame
+    x, y, image, mask = sprite
+    height, width = frame.shape[:2]
+    x0, y0 = max(x, 0), max(y, 0)
+    x1, y1 = min(x + image.shape[1], width), min(y + image.shape[0], height)
+    if x0 >= x1 or y0 >= y1:
+        return frame
+    frame = frame.copy()
+    visible = mask[y0 - y:y1 - y, x0 - x:x1 - x]
+    frame[y0:y1, x0:x1][visible] = image[y0 - y:y1 - y, x0 - x:x1 - x][visible]
+    return frame
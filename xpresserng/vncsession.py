@@ -0,0 +1,301 @@
+# (c) Jan Sedlak, Red Hat
+"""Long-lived VNC connections driven from synchronous code.
+
+vncdotool is built on Twisted, so the reactor runs in one daemon thread
+shared by every session in the process and callers block on the result
+of each request. One VncSession keeps one connection to one machine open
+for its whole lifetime instead of reconnecting for every action.
+"""
+
+import threading
+import logging
+import time
+
+from twisted.internet import reactor
+from twisted.internet.defer import succeed
+from twisted.internet.threads import blockingCallFromThread
+
+from xpresserng.errors import XpresserngError
+from vncdotool.client import VNCDoToolClient, VNCDoToolFactory
+from vncdotool.command import build_command_list
+
+
+_reactor_thread = None
+_reactor_lock = threading.Lock()
+
+# seconds without a new frame after which adaptive pacing considers the
+# screen settled
+QUIET_PERIOD = 0.05
+# seconds to get from connecting to ServerInit before giving up
+CONNECT_TIMEOUT = 30
+
+
+class VncSessionError(XpresserngError):
+    """Error related to the VNC connection itself."""
+
+
+def start_reactor():
+    """Start the Twisted reactor in a background thread, once per process."""
+    global _reactor_thread
+    with _reactor_lock:
+        if _reactor_thread is None:
+            _reactor_thread = threading.Thread(target=reactor.run, name="vnc-reactor",
+                                               kwargs={"installSignalHandlers": False})
+            _reactor_thread.daemon = True
+            _reactor_thread.start()
+
+
+class VncSessionFactory(VNCDoToolFactory):
+    """Factory which reports connection loss back to its session.
+
+    Its clients keep their framebuffer current with incremental updates,
+    so a capture is just a read of the last committed frame. The mouse
+    pointer is sent apart from the screen, frames do not include it.
+    """
+
+    incremental = True
+    pseudocusor = True
+
+    def __init__(self, session):
+        VNCDoToolFactory.__init__(self)
+        self.session = session
+        self.made = False
+
+    def buildProtocol(self, addr):
+        protocol = VNCDoToolFactory.buildProtocol(self, addr)
+        # frame ids go on across reconnects, so ids of a lost connection
+        # never name frames of the new one
+        protocol.frame_id = protocol.first_frame_id = self.session.last_frame_id
+        return protocol
+
+    def clientConnectionMade(self, protocol):
+        self.made = True
+        VNCDoToolFactory.clientConnectionMade(self, protocol)
+
+    def clientConnectionFailed(self, connector, reason):
+        if self.deferred is not None:
+            VNCDoToolFactory.clientConnectionFailed(self, connector, reason)
+
+    def clientConnectionLost(self, connector, reason):
+        if self.deferred is not None:
+            # closed before ServerInit, e.g. refused password
+            VNCDoToolFactory.clientConnectionFailed(self, connector, reason)
+        elif self.made:
+            self.session.connection_lost(reason)
+
+    def connectTimedOut(self, connector):
+        """Fail connecting unless ServerInit came in the meantime."""
+        if self.deferred is not None:
+            d, self.deferred = self.deferred, None
+            connector.disconnect()
+            d.errback(VncSessionError("no ServerInit within %s seconds" % CONNECT_TIMEOUT))
+
+    def frameCommitted(self, protocol):
+        self.session.frame_committed(protocol)
+
+    def desktopResized(self, protocol, width, height):
+        self.session.desktop_resized(protocol, width, height)
+
+
+class VncSession(object):
+    """One persistent VNC connection to a target machine.
+
+    Commands use the vncdotool command line vocabulary (key, type, move,
+    click, capture, ...) and are executed over the already established
+    connection, which is opened lazily and reopened when it is lost.
+    """
+
+    def __init__(self, host, port, password=None, delay=0.1, quality=None, compression=None,
+                 bpp=32, pacing=0, adaptive=False):
+        """Initialize session, delay is number of seconds to wait after commands.
+
+        Quality (0-9) lets the server send JPEG compressed rectangles,
+        compression (0-9) sets its zlib level, see set_quality. Bits per
+        pixel of 16 or 8 reduce colours to save bandwidth. Input events are
+        sent pacing seconds apart, all at once when it is 0.
+
+        Adaptive sessions do not always wait delay seconds after commands,
+        only until the screen is QUIET_PERIOD seconds without updates, see
+        wait_until_stable.
+        """
+        self.host = host
+        self.port = port
+        self.password = password
+        self.delay = delay
+        self.quality = quality
+        self.compression = compression
+        self.bpp = bpp
+        self.pacing = pacing
+        self.adaptive = adaptive
+        self.actions = 0
+        self.saved_time = 0.0
+        self.client = None
+        self.last_frame_id = 0
+        self.resolution = None
+        self.resize_callbacks = []
+        self._lock = threading.Lock()
+        self._frame_condition = threading.Condition()
+
+    def connect(self):
+        """Connect to VNC server unless already connected and return client."""
+        with self._lock:
+            if self.client is None:
+                start_reactor()
+                try:
+                    self.client = blockingCallFromThread(reactor, self._connect)
+                except Exception as e:
+                    raise VncSessionError("Cannot connect to VNC at %s:%s: %s" %
+                                          (self.host, self.port, e))
+                self.resolution = (self.client.width, self.client.height)
+                logging.debug("connected to VNC at %s:%s", self.host, self.port)
+            return self.client
+
+    def _connect(self):
+        factory = VncSessionFactory(self)
+        factory.password = self.password
+        factory.quality = self.quality
+        factory.compression = self.compression
+        factory.bpp = self.bpp
+        factory.pacing = self.pacing
+        d = factory.deferred
+        connector = reactor.connectTCP(self.host, self.port, factory, CONNECT_TIMEOUT)
+        timer = reactor.callLater(CONNECT_TIMEOUT, factory.connectTimedOut, connector)
+
+        def cancel(result):
+            if timer.active():
+                timer.cancel()
+            return result
+        return d.addBoth(cancel)
+
+    def connection_lost(self, reason):
+        """Forget client of lost connection."""
+        logging.debug("VNC connection to %s:%s lost: %s", self.host, self.port,
+                      reason.getErrorMessage())
+        with self._frame_condition:
+            self.client = None
+            self._frame_condition.notify_all()
+
+    def frame_committed(self, client):
+        """Wake up everybody waiting for a new frame."""
+        self.last_frame_id = client.frame_id
+        with self._frame_condition:
+            self._frame_condition.notify_all()
+
+    def desktop_resized(self, client, width, height):
+        """Remember new resolution and tell it to resize_callbacks.
+
+        Callbacks get (width, height) and are called in the reactor thread,
+        before the first frame of the new resolution is committed.
+        """
+        logging.debug("VNC at %s:%s resized to %dx%d", self.host, self.port, width, height)
+        self.resolution = (width, height)
+        for callback in self.resize_callbacks:
+            callback(width, height)
+
+    def wait_for_frame(self, after=None, timeout=None):
+        """Wait until a frame newer than frame id after is committed.
+
+        Return id of the newest frame, or None when timeout seconds passed
+        without one. With after None, any committed frame will do.
+        """
+        client = self.connect()
+        if timeout is not None:
+            deadline = time.time() + timeout
+        with self._frame_condition:
+            while client.frame_id <= (after or 0):
+                if timeout is None:
+                    self._frame_condition.wait()
+                else:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        return None
+                    self._frame_condition.wait(remaining)
+                if self.client is not client:
+                    raise VncSessionError("VNC connection to %s:%s lost" % (self.host, self.port))
+            return client.frame_id
+
+    def wait_until_stable(self, region=None, quiet=0.3, timeout=None):
+        """Wait until region (x, y, width, height) of the screen, or all of
+        it, has not been updated for quiet seconds, counted from now.
+
+        Return True once stable, False when timeout seconds passed first.
+        """
+        client = self.connect()
+        start = time.time()
+        after = client.frame_id
+        while True:
+            changed = self.call(client.lastChange, region)
+            stable_at = max(start, changed or start) + quiet
+            now = time.time()
+            if now >= stable_at:
+                return True
+            if timeout is not None and now >= start + timeout:
+                return False
+            wait_until = stable_at if timeout is None else min(stable_at, start + timeout)
+            frame_id = self.wait_for_frame(after, wait_until - now)
+            if frame_id is not None:
+                after = frame_id
+
+    def call(self, function, *args, **kwargs):
+        """Call function in reactor thread and wait for its (deferred) result."""
+        return blockingCallFromThread(reactor, function, *args, **kwargs)
+
+    def run(self, commands):
+        """Execute list of vncdotool commands over the connection.
+
+        Key and pointer events of all commands are written at once (or
+        paced), only pause and screen commands wait in between.
+        """
+        client = self.connect()
+        if not self.adaptive:
+            self.call(self._run, client, list(commands), self.delay)
+            return
+        self.call(self._run, client, list(commands), None)
+        start = time.time()
+        self.wait_until_stable(None, QUIET_PERIOD, self.delay)
+        waited = time.time() - start
+        self.actions += 1
+        self.saved_time += max(0.0, self.delay - waited)
+
+    def _run(self, client, commands, delay):
+        d = succeed(client.bufferInput())
+        build_command_list(d, commands)
+        if delay is None:
+            d.addCallback(VNCDoToolClient.flushInput)
+        else:
+            d.addCallback(VNCDoToolClient.pause, delay)
+        return d
+
+    def set_quality(self, quality=None, compression=None):
+        """Set JPEG quality and compression level of the Tight encoding.
+
+        Quality None means lossless updates; when switching to it, the whole
+        screen is requested again so no lossy pixels remain.
+        """
+        self.quality = quality
+        self.compression = compression
+        client = self.connect()
+        self.call(client.setQuality, quality, compression)
+
+    def capture(self, since=None):
+        """Capture current screen of the target machine.
+
+        Return tuple of frame id, BGR numpy array without the mouse
+        pointer, list of rectangles updated after frame since (None when
+        not known) and (x, y, image, mask) of the pointer or None.
+        """
+        client = self.connect()
+        return self.call(self._capture, client, since)
+
+    def _capture(self, client, since):
+        d = client.captureFrame()
+        d.addCallback(lambda frame: (client.frame_id, frame, client.dirtySince(since),
+                                     client.cursorSprite()))
+        return d
+
+    def close(self):
+        """Close the connection."""
+        with self._lock:
+            client, self.client = self.client, None
+        if client is not None:
+            self.call(client.transport.loseConnection)
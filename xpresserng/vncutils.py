@@ -2,16 +2,13 @@
 import cv2
 
 import types
-import subprocess
-import os
 import logging
 
-from image import Image
+from image import Screenshot
 from tempfile import NamedTemporaryFile
 
-ABSPATH = os.path.dirname(os.path.abspath(__file__))
-
-from vncdotool.client import KEYMAP
+from vncdotool.client import KEYMAP, PIXEL_FORMATS
+from vncsession import VncSession
 
 
 def to_special(string):
@@ -74,15 +71,34 @@ class VncTool(object):
     """Class for controlling target machine via VNC.
 
     It provides methods for typing on keyboard, clicking with mouse and
-    screenshotting desktop.
+    screenshotting desktop. All of them go over one persistent VNC session.
     """
 
-    def __init__(self, host, port, password):
-        """Initialize VncTool with host, port and password for VNC it will use."""
-        #TODO: TBD password usage
+    def __init__(self, host, port, password, quality=None, compression=None, bpp=32, pacing=0,
+                 adaptive=False):
+        """Initialize VncTool with host, port and password for VNC it will use.
+
+        Quality and compression tune the Tight encoding, see set_quality.
+        Screen is transferred with bpp (32, 16 or 8) bits per pixel. Input
+        events of one action are sent pacing seconds apart, at once for 0.
+        Adaptive tool waits after actions only until the screen settles.
+        """
         self.host = host
         self.password = password
         self.port = port
+        self.frame_id = None
+        self.batch_commands = None
+        if bpp not in PIXEL_FORMATS:
+            raise ValueError("Unsupported bits per pixel: %s" % bpp)
+        pixel_format = PIXEL_FORMATS[bpp]
+        if bpp < 32:
+            self.levels = (pixel_format["bluemax"], pixel_format["greenmax"],
+                           pixel_format["redmax"])
+        else:
+            self.levels = None
+        self.session = VncSession(host, port, password, delay=0.1,
+                                  quality=quality, compression=compression, bpp=bpp,
+                                  pacing=pacing, adaptive=adaptive)
         self.run_vnc_function = self.create_vnc_function(host, port, password)
 
     def create_vnc_function(self, host, port, password):
@@ -90,14 +106,46 @@ class VncTool(object):
 
         def run_vncdotool(commands):
             if commands[0] != "capture":
-                logging.debug("#DEBUG reactor:", commands)
-                #TODO: vncdotool cannot be used as a library.... yet
-            subprocess.call(
-                ["python", os.path.join(ABSPATH, "vncdotool/command.py"), "--delay=100", "-s",
-                 host + "::" + str(port)] + commands)
+                logging.debug("#DEBUG reactor: %s", commands)
+            if self.batch_commands is not None:
+                self.batch_commands.extend(commands)
+            else:
+                self.session.run(commands)
 
         return run_vncdotool
 
+    def begin_batch(self):
+        """Queue commands instead of running them, until end_batch."""
+        self.batch_commands = []
+
+    def flush_batch(self):
+        """Run commands queued so far as one sequence, batching goes on."""
+        if self.batch_commands:
+            commands, self.batch_commands = self.batch_commands, []
+            self.session.run(commands)
+
+    def end_batch(self, sync=False, timeout=10):
+        """Run queued commands and stop batching.
+
+        With sync, wait up to timeout seconds for the first frame committed
+        after the commands were sent.
+        """
+        try:
+            frame_id = self.session.connect().frame_id
+            self.flush_batch()
+        finally:
+            self.batch_commands = None
+        if sync:
+            self.session.wait_for_frame(frame_id, timeout)
+
+    def close(self):
+        """Close VNC session."""
+        self.session.close()
+
+    def set_quality(self, quality=None, compression=None):
+        """Set JPEG quality (0-9, None is lossless) and compression level (0-9)."""
+        self.session.set_quality(quality, compression)
+
     def click(self, x, y):
         """Click on given coordinates with mouse."""
         commands = ['move', str(x), str(y), 'click', '1']
@@ -160,17 +208,35 @@ class VncTool(object):
         commands = ["key", keys]
         self.run_vnc_function(commands)
 
-    def take_screenshot(self, debug=True):
-        """Take screenshot of desktop and return name of file where was it saved."""
-        with NamedTemporaryFile(prefix='xpresserng_', suffix='.png', delete=not debug) as f:
-            commands = ['capture', f.name]
-            self.run_vnc_function(commands)
-            opencv_image = cv2.imread(f.name)
-        if opencv_image is not None:
-            return Image("screenshot", array=opencv_image,
-                         width=len(opencv_image[0]), height=len(opencv_image))
+    def take_screenshot(self, debug=False):
+        """Take screenshot of desktop and return it as Image.
+
+        Screen is read straight from the VNC framebuffer, without the mouse
+        pointer; it is written to a temporary file, pointer drawn in, only
+        when debug is set. Id of the captured frame is kept in frame_id,
+        the screenshot knows what has changed since the previous one.
+        """
+        self.flush_batch()
+        since = self.frame_id
+        self.frame_id, opencv_image, dirty, cursor = self.session.capture(since)
+        screenshot = Screenshot(opencv_image, frame_id=self.frame_id, dirty_since=since,
+                                dirty=dirty, levels=self.levels, cursor=cursor)
+        if debug:
+            with NamedTemporaryFile(prefix='xpresserng_', suffix='.png', delete=False) as f:
+                cv2.imwrite(f.name, screenshot.composited())
+                logging.debug("screenshot saved to %s", f.name)
+        return screenshot
+
+    def wait_for_frame(self, after=None, timeout=None):
+        """Wait for a frame newer than after, return its id or None on timeout."""
+        self.flush_batch()
+        return self.session.wait_for_frame(after, timeout)
+
+    def wait_until_stable(self, region=None, quiet=0.3, timeout=None):
+        """Wait until region of screen is not updated for quiet seconds."""
+        self.flush_batch()
+        return self.session.wait_until_stable(region, quiet, timeout)
 
     def log_vm(self, screenshot_name):
-        commands = ['capture', screenshot_name]
-        self.run_vnc_function(commands)
+        cv2.imwrite(screenshot_name, self.take_screenshot().composited())
         # perhaps image of VM RAM?
@@ -20,36 +20,124 @@
 
 # (c) Jan Sedlak, Red Hat
 
+import hashlib
+import logging
+import os
 import time
 import types
 import cv2
+from contextlib import contextmanager
 
 from xpresserng.vncutils import VncTool
 from xpresserng.errors import XpresserngError
 from xpresserng.imagedir import ImageDir
 from xpresserng.imagematch import ImageMatch
-from xpresserng.opencvfinder import OpenCVFinder
+from xpresserng.opencvfinder import OpenCVFinder, resolve_region
+
+
+# (width, height) of recorded video, frames of other resolutions are scaled
+RECORDING_SIZE = (1024, 768)
+# positions of found images are kept between runs in files named after
+# their image directory, in this directory of the user's cache
+POSITIONS_DIR = os.path.join("xpresserng", "positions")
 
 
 class ImageNotFound(XpresserngError):
     """Exception raised when a request to find an image doesn't succeed."""
 
 
+def positions_file(path):
+    """Return file for positions of images of directory path, in the cache."""
+    cache = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    name = hashlib.sha1(os.path.abspath(path)).hexdigest()[:16] + ".json"
+    return os.path.join(cache, POSITIONS_DIR, name)
+
+
+class Region(object):
+    """Part of the screen which images are searched for in.
+
+        bottom = xp.region(0, 0.8, 1.0, 0.2)
+        bottom.click("continue")
+
+    Returned by Xpresserng.region; find, wait and clicks by image name
+    only search inside of it.
+    """
+
+    def __init__(self, xpng, x, y, width, height):
+        self._xpng = xpng
+        self.area = (x, y, width, height)
+
+    def find(self, image, timeout=10):
+        """Like Xpresserng.find, searching in the region only."""
+        return self._xpng.find(image, timeout, self.area)
+
+    def wait(self, image, timeout=30):
+        """Like Xpresserng.wait, searching in the region only."""
+        return self._xpng.wait(image, timeout, self.area)
+
+    def click(self, *args):
+        self._xpng._vnctool.click(*self._xpng._compute_focus_point(args, self.area))
+
+    def right_click(self, *args):
+        self._xpng._vnctool.right_click(*self._xpng._compute_focus_point(args, self.area))
+
+    def double_click(self, *args):
+        self._xpng._vnctool.double_click(*self._xpng._compute_focus_point(args, self.area))
+
+    def hover(self, *args):
+        self._xpng._vnctool.hover(*self._xpng._compute_focus_point(args, self.area))
+
+    def wait_until_stable(self, quiet=0.3, timeout=10):
+        """Like Xpresserng.wait_until_stable, watching the region only."""
+        return self._xpng.wait_until_stable(self.area, quiet, timeout)
+
+
 class Xpresserng(object):
-    def __init__(self, host="127.0.0.1", port=5900, password=None, debug=False):
+    def __init__(self, host="127.0.0.1", port=5900, password=None, debug=False,
+                 quality=None, compression=None, bpp=32, pacing=0, adaptive=False,
+                 pyramid=False, executor=None):
+        """Connect to VNC server of the target machine.
+
+        For remote or crowded hosts, compression (0-9) sets zlib level of
+        the Tight encoding and quality (0-9) allows lossy JPEG updates,
+        see set_quality. Bpp of 16 (RGB565) or 8 (RGB332) transfers fewer
+        colours; images are then reduced to the same colours before they
+        are searched for. Key presses and clicks of one action are sent in
+        one write, or pacing seconds apart for guests which drop fast input.
+
+        After every action the screen is given 0.1 s to react. Adaptive
+        mode stops waiting as soon as the screen settles, see pacing_stats.
+
+        Pyramid mode matches images on a downscaled grayscale screen first
+        and at full resolution only where they are likely to be. With an
+        executor, e.g. concurrent.futures.ThreadPoolExecutor, strips of the
+        screen, or several images at once, are searched on several cores.
+        """
         self._imagedir = ImageDir()
-        self._imagefinder = OpenCVFinder()
-        self._vnctool = VncTool(host, port, password)
+        self._imagefinder = OpenCVFinder(pyramid=pyramid, executor=executor)
+        self._positions_file = None
+        self._vnctool = VncTool(host, port, password, quality, compression, bpp, pacing,
+                                adaptive)
         self.debug = debug
         self.recording = False
+        self.quality = quality
+        self.compression = compression
+
+    def load_images(self, path, positions=None):
+        """Load images of directory path and where they were found last time.
 
-    def load_images(self, path):
+        @param positions: File to keep positions of found images in between
+            runs, by default one in the user's cache, see positions_file.
+        """
         self._imagedir.load(path)
+        self._positions_file = positions or positions_file(path)
+        if os.path.exists(self._positions_file):
+            self._imagefinder.load_positions(self._positions_file)
 
     def get_image(self, name):
         return self._imagedir.get(name)
 
-    def _compute_focus_point(self, args):
+    def _compute_focus_point(self, args, region=None):
         if (len(args) == 2 and
                 isinstance(args[0], (int, long)) and
                 isinstance(args[1], (int, long))):
@@ -58,15 +146,37 @@ class Xpresserng(object):
             if type(args[0]) == ImageMatch:
                 match = args[0]
             else:
-                match = self.find(args[0])
+                match = self.find(args[0], region=region)
             return match.focus_point
 
     def set_recording(self, filename):
         self.recording = True
         self.video_file = filename
-        self.video_writer = cv2.VideoWriter(self.video_file, cv2.cv.CV_FOURCC(*"XVID"), 2, (1024, 768),
+        self.video_writer = cv2.VideoWriter(self.video_file, cv2.cv.CV_FOURCC(*"XVID"), 2, RECORDING_SIZE,
                                             True)  # TODO: webm would be better
 
+    def _record(self, screenshot_image):
+        frame = screenshot_image.composited()
+        if (screenshot_image.width, screenshot_image.height) != RECORDING_SIZE:
+            # resolution switches during boot
+            frame = cv2.resize(frame, RECORDING_SIZE)
+        self.video_writer.write(frame)
+
+    @property
+    def resolution(self):
+        """(width, height) of the screen, None until connected."""
+        return self._vnctool.session.resolution
+
+    def on_resize(self, callback):
+        """Call callback(width, height) whenever the screen resolution changes.
+
+        Callbacks run in the thread of the Twisted reactor, before the
+        first frame of the new resolution is committed, so they must not
+        block nor call back into Xpresserng; hand the change over to
+        another thread instead.
+        """
+        self._vnctool.session.resize_callbacks.append(callback)
+
     def click(self, *args):
         """Click on the position specified by the provided arguments.
 
@@ -110,10 +220,12 @@ class Xpresserng(object):
         """
         self._vnctool.hover(*self._compute_focus_point(args))
 
-    def find(self, image, timeout=10):
+    def find(self, image, timeout=10, region=None):
         """Given an image or an image name, find it on the screen.
 
         @param image: Image or image name or list of names to be searched for.
+        @param region: (x, y, width, height) part of the screen to search in,
+            see region.  By default the region of each image.
         @return: An ImageMatch instance, or None.
         """
         if isinstance(image, basestring):
@@ -122,30 +234,56 @@ class Xpresserng(object):
             for i, im in enumerate(image):
                 image[i] = self._imagedir.get(im)
         wait_until = time.time() + timeout
+        frame_id = None
         while time.time() < wait_until:
+            # nothing to do until the screen changes
+            if self._vnctool.wait_for_frame(frame_id, wait_until - time.time()) is None:
+                break
             screenshot_image = self._vnctool.take_screenshot(debug=self.debug)
+            frame_id = self._vnctool.frame_id
             if self.recording:
                 if self.video_writer:
-                    if screenshot_image.width == 1024 and screenshot_image.height == 768:  # TODO: tis no pretty
-                        self.video_writer.write(screenshot_image.array)
+                    self._record(screenshot_image)
             if isinstance(image, types.ListType):
-                for im in image:
-                    match = self._imagefinder.find(screenshot_image, im)
-                    if match is not None:
-                        return match
+                match = self._imagefinder.find_any(screenshot_image, image, region=region)
+                if match is not None:
+                    return match
             else:
-                match = self._imagefinder.find(screenshot_image, image)
+                match = self._imagefinder.find(screenshot_image, image, region)
                 if match is not None:
                     return match
         raise ImageNotFound(image)
 
-    def wait(self, image, timeout=30):
+    def wait(self, image, timeout=30, region=None):
         """Wait for an image to show up in the screen up to C{timeout} seconds.
 
         @param image: Image or image name to be searched for.
         @return: An ImageMatch instance, or None.
         """
-        self.find(image, timeout)
+        self.find(image, timeout, region)
+
+    def region(self, x, y, width, height):
+        """Return Region of the screen to find images and click in.
+
+        Float values are fractions of the screen width or height, so
+        region(0.5, 0, 0.5, 1.0) is the right half of the screen.
+        """
+        return Region(self, x, y, width, height)
+
+    def wait_until_stable(self, region=None, quiet=0.3, timeout=10):
+        """Wait until the screen stops changing, e.g. a dialog is drawn.
+
+        @param region: (x, y, width, height) part of the screen to watch,
+            whole screen when None. Floats are fractions as in region.
+        @param quiet: Seconds without any update in region, counted from
+            the call, after which it is considered stable.
+        @return: True when stable, False when timeout seconds passed first.
+        """
+        if region is not None:
+            # fractions need the resolution, known once connected
+            self._vnctool.session.connect()
+            region = resolve_region(region, *self.resolution)
+        return self._vnctool.wait_until_stable(region, quiet, timeout)
 
     def type(self, string):
         """Enter the string provided as if it was typed via the keyboard.
@@ -162,3 +300,75 @@ class Xpresserng(object):
     def log_vm(self, screenshot_filename):
         """Log information about virtual machine, save screenshot."""
         self._vnctool.log_vm(screenshot_filename)
+
+    def set_quality(self, quality=None, compression=None):
+        """Set JPEG quality of screen updates, None for lossless.
+
+        Lossy updates save bandwidth but blur the screen, so they are meant
+        for recording or watching the machine only; image matching should
+        be done in lossless mode (see lossless). Compression is the zlib
+        level (0-9) used by the server.
+        """
+        self.quality = quality
+        self.compression = compression
+        self._vnctool.set_quality(quality, compression)
+
+    @contextmanager
+    def lossless(self):
+        """Context manager forcing lossless screen updates inside its block.
+
+            with xp.lossless():
+                xp.wait("image-name")
+        """
+        quality = self.quality
+        if quality is not None:
+            self.set_quality(None, self.compression)
+        try:
+            yield self
+        finally:
+            if quality is not None:
+                self.set_quality(quality, self.compression)
+
+    def pacing_stats(self):
+        """Return number of actions and seconds adaptive pacing saved on them."""
+        session = self._vnctool.session
+        return session.actions, session.saved_time
+
+    @contextmanager
+    def batch(self, sync=False, timeout=10):
+        """Context manager sending clicks, hovers and typing as one sequence.
+
+            with xp.batch(sync=True):
+                xp.type("test")
+                xp.type("<tab>")
+
+        Actions are queued and sent when the block exits, finding an image
+        sends the ones queued before it first. With sync, wait up to
+        timeout seconds for the screen to be updated after them.
+        """
+        if self._vnctool.batch_commands is not None:
+            # nested in another batch, which sends everything
+            yield self
+            return
+        self._vnctool.begin_batch()
+        try:
+            yield self
+        finally:
+            self._vnctool.end_batch(sync, timeout)
+
+    def prior_stats(self):
+        """Return number of finds at a position an image was seen at before
+        and number of finds of images seen before."""
+        return self._imagefinder.prior_stats()
+
+    def close(self):
+        """Close connection to the target machine, save image positions."""
+        if self._positions_file is not None:
+            try:
+                directory = os.path.dirname(self._positions_file)
+                if directory and not os.path.isdir(directory):
+                    os.makedirs(directory)
+                self._imagefinder.save_positions(self._positions_file)
+            except (IOError, OSError) as e:
+                logging.warning("cannot save image positions: %s", e)
+        self._vnctool.close()